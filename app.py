@@ -1,34 +1,25 @@
 import streamlit as st
-import os
-import tempfile
-import zipfile
-import io
-from telethon import TelegramClient, functions, types
 from telethon.errors import SessionPasswordNeededError
-from telethon.sessions import StringSession
-import asyncio
-import nest_asyncio
-from PIL import Image
-import base64
-from datetime import datetime
 import atexit
+import concurrent.futures
+import logging
+import time
+import tempfile
+import uuid
+import os
+import hashlib
+from urllib.parse import quote
+from favorites_core import (
+    DEFAULT_API_ID, DEFAULT_API_HASH, ARCHIVE_DIR, MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES,
+    FAVORITES_CACHE_TTL, QUOTA_SESSION_JOBS, QUOTA_TOTAL_JOBS, QUOTA_SESSION_BYTES, QUOTA_TOTAL_BYTES,
+    QUOTA_ARCHIVE_BYTES, QUOTA_CLIENTS, BackgroundLoop, AdmissionController, ClientPool, MediaCache, FavoritesCache, fetch_favorites, save_media, write_volumes, fetch_previews,
+    has_preview, preview_cache_key, remove_cached_media, filter_media, estimate_archive_size, plan_volumes, get_volume_path, load_media_index, clear_media_index, get_manifest_path, remove_archive,
+    remove_stale_archives,
+)
+from metrics import metrics, start_metrics_server
+from media_server import start_media_server
 
-# Применение nest_asyncio для исправления цикла событий в Streamlit
-nest_asyncio.apply()
-
-# Глобальный список активных клиентов для корректного закрытия
-active_clients = []
-
-# Функция для корректного закрытия всех клиентов при завершении работы
-def cleanup_clients():
-    for client in active_clients:
-        try:
-            asyncio.run_coroutine_threadsafe(client.disconnect(), asyncio.get_event_loop())
-        except:
-            pass
-
-# Регистрация функции для закрытия клиентов при выходе
-atexit.register(cleanup_clients)
+log = logging.getLogger(__name__)
 
 # Настройки приложения
 st.set_page_config(
@@ -43,62 +34,194 @@ try:
     API_HASH = st.secrets["API_HASH"]
 except KeyError:
     # Для локальной разработки используем значения по умолчанию
-    API_ID = 1713092
-    API_HASH = "c96e3d68d80373c29270bb8a2edbb1f5"
+    API_ID = DEFAULT_API_ID
+    API_HASH = DEFAULT_API_HASH
+
+# Сколько секунд список избранного берется из памяти без сверки с Telegram
+try:
+    FAVORITES_TTL = st.secrets["FAVORITES_CACHE_TTL"]
+except KeyError:
+    FAVORITES_TTL = FAVORITES_CACHE_TTL
+
+# Метрики: порт HTTP-сервера Prometheus (GET /metrics) и токен страницы администратора (?admin=<токен>)
+# Без настроек в секретах сервер не запускается, а страница недоступна
+try:
+    METRICS_PORT = st.secrets["METRICS_PORT"]
+except KeyError:
+    METRICS_PORT = None
+try:
+    METRICS_HOST = st.secrets["METRICS_HOST"]
+except KeyError:
+    METRICS_HOST = "127.0.0.1"
+try:
+    ADMIN_TOKEN = st.secrets["ADMIN_TOKEN"]
+except KeyError:
+    ADMIN_TOKEN = None
 
-# Функция для запуска асинхронных операций
-def run_async(coro):
+# Сервер потокового воспроизведения и скачивания файлов: порт и адрес, на которых он слушает,
+# и адрес, по которому к нему обращается браузер пользователя. Сервер запускается, только если адрес
+# задан в секретах: браузер должен до него дотянуться (на Streamlit Cloud открыт лишь порт приложения).
+# Без него видео и аудио не воспроизводятся на странице, а файлы отдаются через st.download_button
+try:
+    MEDIA_SERVER_PORT = st.secrets["MEDIA_SERVER_PORT"]
+except KeyError:
+    MEDIA_SERVER_PORT = 8502
+try:
+    MEDIA_SERVER_HOST = st.secrets["MEDIA_SERVER_HOST"]
+except KeyError:
+    MEDIA_SERVER_HOST = "127.0.0.1"
+try:
+    # Streamlit принимает за ссылку только адрес с доменом или IP, "localhost" он считает именем файла
+    MEDIA_SERVER_URL = st.secrets["MEDIA_SERVER_URL"]
+except KeyError:
+    MEDIA_SERVER_URL = None
+
+# Квоты ресурсов процесса (см. AdmissionController): в секретах задаются как QUOTA_SESSION_JOBS и т.д.
+QUOTAS = {
+    'session_jobs': QUOTA_SESSION_JOBS,
+    'total_jobs': QUOTA_TOTAL_JOBS,
+    'session_bytes': QUOTA_SESSION_BYTES,
+    'total_bytes': QUOTA_TOTAL_BYTES,
+    'archive_bytes': QUOTA_ARCHIVE_BYTES,
+    'clients': QUOTA_CLIENTS,
+}
+for quota in QUOTAS:
     try:
-        # Пытаемся использовать существующий цикл событий
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        # Если цикла событий нет, создаем новый
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    
-    return loop.run_until_complete(coro)
-
-# Определить тип медиа
-def get_media_type(message):
-    if message.photo:
-        return 'photo'
-    elif message.video:
-        return 'video'
-    elif message.document:
-        return 'document'
-    elif message.audio:
-        return 'audio'
-    elif message.voice:
-        return 'voice'
-    else:
-        return 'unknown'
-
-# Получить имя файла
-def get_filename(message):
-    if message.photo:
-        return f"photo_{message.id}.jpg"
-    elif message.video:
-        return getattr(message.video.attributes[0], 'file_name', f"video_{message.id}.mp4") if hasattr(message.video, 'attributes') and message.video.attributes else f"video_{message.id}.mp4"
-    elif message.document:
-        return getattr(message.document.attributes[0], 'file_name', f"document_{message.id}") if hasattr(message.document, 'attributes') and message.document.attributes else f"document_{message.id}"
-    elif message.audio:
-        return getattr(message.audio.attributes[0], 'file_name', f"audio_{message.id}.mp3") if hasattr(message.audio, 'attributes') and message.audio.attributes else f"audio_{message.id}.mp3"
-    elif message.voice:
-        return f"voice_{message.id}.ogg"
-    else:
-        return f"file_{message.id}"
+        QUOTAS[quota] = st.secrets[f"QUOTA_{quota.upper()}"]
+    except KeyError:
+        pass
+
+# Префикс имен временных архивов и файлов на диске
+ARCHIVE_FILE_PREFIX = "telegram_favorites_archive_"
+JOB_POLL_INTERVAL = 1  # секунд между обновлениями страницы, пока идут фоновые задачи
+FAVORITES_WAIT = 5  # секунд, которые страница ждет обновления списка избранного, прежде чем показать прогресс
+
+# Сетка файлов: сколько файлов в строке и варианты размера страницы (кратны числу колонок)
+GRID_COLUMNS = 3
+PAGE_SIZES = (12, 24, 48, 96)
+DEFAULT_PAGE_SIZE = 24
+
+# Архивы на странице: вид -> (кнопка подготовки, кнопка скачивания, имя файла)
+ARCHIVE_KINDS = {
+    'all': ("Подготовить архив со всеми файлами", "Скачать все файлы", "telegram_favorites"),
+    'selected': ("Подготовить архив с выбранными файлами", "Скачать выбранные файлы", "telegram_favorites_selected"),
+}
+
+# Форматы архива: формат -> (подпись, MIME-тип)
+ARCHIVE_FORMAT_OPTIONS = {
+    'zip': ("ZIP", "application/zip"),
+    'tar': ("TAR (без сжатия, быстрее всего)", "application/x-tar"),
+}
+
+# Размер тома архива: подпись -> байт (None - одним файлом)
+# Тома можно скачивать по мере готовности, не дожидаясь всего архива
+ARCHIVE_VOLUME_SIZES = {
+    "Одним файлом": None,
+    "500 МБ": 500 * 1024 * 1024,
+    "1 ГБ": 1024 * 1024 * 1024,
+    "2 ГБ": 2 * 1024 * 1024 * 1024,
+}
+DEFAULT_ARCHIVE_VOLUME_SIZE = "1 ГБ"
+
+# Типы медиа, которые можно воспроизвести прямо на странице
+STREAM_MEDIA_TYPES = ('video', 'audio', 'voice')
+
+# Названия типов медиа для фильтра
+MEDIA_TYPE_LABELS = {
+    'photo': "Фото",
+    'video': "Видео",
+    'document': "Документы",
+    'audio': "Музыка",
+    'voice': "Голосовые",
+}
+
+# Функция для корректного закрытия всех клиентов при завершении работы
+def cleanup_clients(pool):
+    pool.close_all()
 
-# Создание клиента Telegram с использованием StringSession
-def create_client():
+# Фоновый цикл событий, в котором выполняется весь ввод-вывод Telegram
+@st.cache_resource
+def get_background_loop():
+    background = BackgroundLoop()
+    atexit.register(background.stop)
+    return background
+
+# Пул клиентов общий для всего процесса и переживает перезапуски скрипта
+@st.cache_resource
+def get_client_pool():
+    pool = ClientPool(API_ID, API_HASH, get_background_loop(), AdmissionController(**QUOTAS))
+    # Регистрация функции для закрытия клиентов при выходе
+    atexit.register(cleanup_clients, pool)
+    return pool
+
+# HTTP-сервер метрик запускается один раз на процесс
+@st.cache_resource
+def get_metrics_server():
+    return start_metrics_server(int(METRICS_PORT), METRICS_HOST)
+
+# Сервер потокового воспроизведения запускается один раз на процесс
+# None - адрес сервера не задан или сервер не запустился (например, порт занят)
+@st.cache_resource
+def get_media_server():
+    if not MEDIA_SERVER_URL:
+        return None
+    try:
+        return start_media_server(get_client_pool(), get_media_cache(), int(MEDIA_SERVER_PORT), MEDIA_SERVER_HOST)
+    except OSError as e:
+        log.warning("Сервер потокового воспроизведения не запущен: %s", e)
+        return None
+
+# Кэш медиа общий для всех сессий процесса
+@st.cache_resource
+def get_media_cache():
+    return MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+# Список избранного в памяти, общий для всех сессий процесса
+@st.cache_resource
+def get_favorites_cache():
+    return FavoritesCache(FAVORITES_TTL)
+
+# Ключ клиента в пуле для текущей сессии Streamlit
+def get_client_key():
+    if 'client_key' not in st.session_state:
+        st.session_state.client_key = uuid.uuid4().hex
+    return st.session_state.client_key
+
+# Выполнить async-функцию func(client) с подключенным клиентом текущей сессии
+# Функция выполняется в фоновом цикле, поэтому не должна обращаться к st.*
+def run_with_client(func):
     # Используем StringSession вместо файловой сессии для избежания блокировок
     session_str = st.session_state.get('session_string', '')
-    client = TelegramClient(StringSession(session_str), API_ID, API_HASH)
-    active_clients.append(client)
-    return client
+    return get_client_pool().run(get_client_key(), session_str, func)
+
+# Запустить async-функцию func(client, job) как фоновую задачу и вернуть ее объект Job
+# cost - сколько байт скачает задача, label - ее описание для администратора
+def submit_with_client(func, cost=0, label=None):
+    session_str = st.session_state.get('session_string', '')
+    return get_client_pool().submit(get_client_key(), session_str, func, cost, label)
+
+# Сообщение о задаче, ждущей в очереди из-за квот
+def describe_queue(job):
+    text = f"В очереди ({job.queue_reason})"
+    if job.queue_position:
+        text += f", задач впереди: {job.queue_position}"
+    return text
+
+# Остановить фоновые задачи текущей сессии
+def cancel_session_jobs():
+    for job in get_session_jobs():
+        job.cancel()
+
+# Закрыть клиент текущей сессии и отозвать ее ссылки на воспроизведение и скачивание
+def release_client():
+    if 'client_key' in st.session_state:
+        if get_media_server() is not None:
+            get_media_server().unregister(st.session_state.client_key)
+        get_client_pool().release(st.session_state.client_key)
 
 # Сохранение строки сессии после авторизации
-async def save_session_string(client):
-    session_str = client.session.save()
+def save_session_string():
+    session_str = get_client_pool().session_string(get_client_key())
     st.session_state['session_string'] = session_str
 
 # Главная страница
@@ -119,7 +242,7 @@ def main_page():
         with cols[1]:
             st.markdown("""
             ### 🔒 Безопасность
-            Ваши данные не сохраняются на серверах - всё остается приватным
+            Файлы лишь временно кэшируются на сервере и удаляются при выходе из аккаунта
             """)
         with cols[2]:
             st.markdown("""
@@ -153,28 +276,20 @@ def login_page():
             
             if submit and phone:
                 try:
-                    # Создаем клиента Telegram
-                    client = create_client()
-                    
                     # Отправляем запрос кода подтверждения
-                    async def send_code():
-                        await client.connect()
+                    async def send_code(client):
                         if not await client.is_user_authorized():
                             # Сохраняем результат, который содержит phone_code_hash
                             sent_code = await client.send_code_request(phone)
-                            # Сохраняем сессию после получения кода
-                            await save_session_string(client)
-                            return True, sent_code.phone_code_hash
+                            return True, sent_code.phone_code_hash, None
                         else:
                             # Если уже авторизован
                             user = await client.get_me()
-                            # Сохраняем сессию после успешной авторизации
-                            await save_session_string(client)
-                            st.session_state.user_id = user.id
-                            st.session_state.phone = phone
-                            return False, None
+                            return False, None, user.id
                         
-                    need_code, phone_code_hash = run_async(send_code())
+                    need_code, phone_code_hash, user_id = run_with_client(send_code)
+                    # Сохраняем сессию после получения кода или успешной авторизации
+                    save_session_string()
                     
                     if need_code:
                         st.session_state.phone = phone
@@ -183,6 +298,8 @@ def login_page():
                         st.session_state.page = "verify_code"
                         st.rerun()
                     else:
+                        st.session_state.user_id = user_id
+                        st.session_state.phone = phone
                         st.session_state.page = "dashboard"
                         st.rerun()
                 except Exception as e:
@@ -210,32 +327,24 @@ def verify_code_page():
             
             if submit and code:
                 try:
-                    # Создаем клиента Telegram с сохраненной строкой сессии
-                    client = create_client()
-                    
                     # Получаем необходимые данные
                     phone = st.session_state.phone
                     phone_code_hash = st.session_state.phone_code_hash
                     
                     # Авторизуемся с кодом
-                    async def sign_in():
-                        await client.connect()
+                    async def sign_in(client):
                         try:
                             # Используем phone_code_hash при подтверждении
                             await client.sign_in(phone, code, phone_code_hash=phone_code_hash)
                             user = await client.get_me()
-                            # Сохраняем сессию после успешной авторизации
-                            await save_session_string(client)
-                            await client.disconnect()
                             return user.id, None
                         except SessionPasswordNeededError:
-                            # Сохраняем сессию перед проверкой пароля
-                            await save_session_string(client)
-                            await client.disconnect()
                             # Возвращаем флаг, что требуется двухфакторная аутентификация
                             return None, True
                     
-                    user_id, two_fa_needed = run_async(sign_in())
+                    user_id, two_fa_needed = run_with_client(sign_in)
+                    # Сохраняем сессию после авторизации или перед проверкой пароля
+                    save_session_string()
                     
                     if two_fa_needed:
                         # Если требуется 2FA, перенаправляем на страницу ввода пароля
@@ -271,24 +380,15 @@ def two_fa_page():
             
             if submit and password:
                 try:
-                    # Создаем клиента Telegram с сохраненной строкой сессии
-                    client = create_client()
-                    
                     # Авторизуемся с паролем
-                    async def check_password():
-                        await client.connect()
-                        try:
-                            await client.sign_in(password=password)
-                            user = await client.get_me()
-                            # Сохраняем сессию после успешной авторизации
-                            await save_session_string(client)
-                            await client.disconnect()
-                            return user.id
-                        except Exception as e:
-                            await client.disconnect()
-                            raise e
+                    async def check_password(client):
+                        await client.sign_in(password=password)
+                        user = await client.get_me()
+                        return user.id
                     
-                    user_id = run_async(check_password())
+                    user_id = run_with_client(check_password)
+                    # Сохраняем сессию после успешной авторизации
+                    save_session_string()
                     st.session_state.user_id = user_id
                     st.session_state.page = "dashboard"
                     st.rerun()
@@ -303,6 +403,349 @@ def two_fa_page():
         st.divider()
         st.caption("Этот сервис использует Telegram API и не связан с Telegram Inc.")
 
+# Токен ссылок текущей сессии на сервере потокового воспроизведения
+def get_media_token():
+    return get_media_server().register(get_client_key(), st.session_state.get('session_string', ''))
+
+# Ссылка на подготовленный файл path: сервер отдает его с диска, в память Streamlit файл не читается
+def get_file_url(path, file_name, mime=None):
+    token = get_media_token()
+    file_id = get_media_server().add_file(get_client_key(), path, file_name, mime)
+    return f"{MEDIA_SERVER_URL.rstrip('/')}/file/{token}/{file_id}/{quote(file_name, safe='')}"
+
+# Плеер видео или аудио: файл не скачивается целиком, плеер запрашивает у сервера
+# потокового воспроизведения только нужные байты
+def render_player(item):
+    if not st.toggle("Воспроизвести", key=f"play_{item['id']}"):
+        return
+    url = f"{MEDIA_SERVER_URL.rstrip('/')}/media/{get_media_token()}/{item['id']}"
+    if item['type'] == 'video':
+        st.video(url, format=item['mime_type'] or "video/mp4")
+    else:
+        st.audio(url, format=item['mime_type'] or "audio/mpeg")
+
+# Кнопка скачивания одного файла: файл загружается в фоне только по запросу пользователя
+def render_file_download(item):
+    jobs = st.session_state.setdefault('file_jobs', {})
+    job = jobs.get(item['id'])
+    
+    if job is None:
+        if st.button("Подготовить", key=f"prepare_{item['id']}"):
+            jobs[item['id']] = start_media_download(item)
+            st.rerun()
+        return
+    
+    if job.running():
+        if job.queued:
+            st.caption(describe_queue(job))
+        elif job.total_count:
+            st.progress(job.progress(), text=f"Загрузка: {format_size(job.done_count)} из {format_size(job.total_count)}")
+        else:
+            st.caption("Загрузка файла...")
+        if st.button("Отменить", key=f"cancel_{item['id']}"):
+            job.cancel()
+            del jobs[item['id']]
+            st.rerun()
+        return
+    
+    path = job.result()
+    if path is None or not os.path.exists(path):
+        if job.error() is not None:
+            metrics.inc('telegram_errors_total')
+            st.error(f"Ошибка при скачивании: {str(job.error())}")
+        else:
+            st.warning("Файл недоступен")
+        if st.button("Повторить", key=f"retry_{item['id']}"):
+            del jobs[item['id']]
+            st.rerun()
+        return
+    
+    if get_media_server() is not None:
+        st.link_button("Скачать", get_file_url(path, item['filename'], item['mime_type']))
+        return
+    
+    # Без сервера файл читается с диска при каждом обновлении страницы, но не хранится в памяти сессии
+    with open(path, 'rb') as media_data:
+        st.download_button(
+            label="Скачать",
+            data=media_data,
+            file_name=item['filename'],
+            key=f"download_{item['id']}"
+        )
+
+# Путь архива для набора файлов archive_key в текущей сессии
+# Путь постоянный, чтобы прерванную сборку можно было продолжить
+def get_archive_path(archive_key, archive_format="zip"):
+    digest = hashlib.sha1(repr(archive_key).encode()).hexdigest()[:16]
+    return os.path.join(get_archive_dir(), f"{ARCHIVE_FILE_PREFIX}{get_client_key()}_{digest}.{archive_format}")
+
+# Каталог временных архивов
+def get_archive_dir():
+    return ARCHIVE_DIR or tempfile.gettempdir()
+
+# Удалить все архивы текущей сессии
+def remove_session_archives():
+    if 'client_key' not in st.session_state:
+        return
+    prefix = f"{ARCHIVE_FILE_PREFIX}{st.session_state.client_key}_"
+    for name in os.listdir(get_archive_dir()):
+        if name.startswith(prefix):
+            os.remove(os.path.join(get_archive_dir(), name))
+
+# Размер в читаемом виде
+def format_size(size):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Параметры архивов: формат и размер тома
+def render_archive_options():
+    with st.expander("Параметры архива"):
+        col1, col2 = st.columns(2)
+        with col1:
+            archive_format = st.radio(
+                "Формат",
+                options=list(ARCHIVE_FORMAT_OPTIONS),
+                format_func=lambda name: ARCHIVE_FORMAT_OPTIONS[name][0],
+                horizontal=True,
+                key="archive_format"
+            )
+        with col2:
+            volume_label = st.selectbox(
+                "Размер тома",
+                options=list(ARCHIVE_VOLUME_SIZES),
+                index=list(ARCHIVE_VOLUME_SIZES).index(DEFAULT_ARCHIVE_VOLUME_SIZE),
+                key="archive_volume_size"
+            )
+    return archive_format, ARCHIVE_VOLUME_SIZES[volume_label]
+
+# Кнопки скачивания готовых томов архива kind
+def render_volume_downloads(paths, volume_count, kind, archive_format):
+    _, download_label, file_name = ARCHIVE_KINDS[kind]
+    format_label, mime = ARCHIVE_FORMAT_OPTIONS[archive_format]
+    for index, path in enumerate(paths):
+        if volume_count > 1:
+            label = f"{download_label}: том {index + 1} из {volume_count}"
+            name = f"{file_name}_{index + 1:03d}.{archive_format}"
+        else:
+            label = f"{download_label} ({archive_format.upper()})"
+            name = f"{file_name}.{archive_format}"
+        if get_media_server() is not None:
+            st.link_button(label, get_file_url(path, name, mime), use_container_width=True)
+            continue
+        with open(path, 'rb') as archive_data:
+            if st.download_button(
+                label=label,
+                data=archive_data,
+                file_name=name,
+                mime=mime,
+                key=f"download_archive_{kind}_{index}",
+                use_container_width=True
+            ):
+                st.success("Скачивание началось!")
+
+# Кнопка скачивания архива kind (см. ARCHIVE_KINDS): архив собирается в фоне только по запросу пользователя
+def render_archive_download(favorites, kind="all", archive_format="zip", volume_size=None):
+    prepare_label = ARCHIVE_KINDS[kind][0]
+    archive_jobs = st.session_state.setdefault('archive_jobs', {})
+    prepared_archives = st.session_state.setdefault('prepared_archives', {})
+    
+    # Подготовленный архив действителен, пока не изменились список файлов и параметры
+    archive_key = (kind, archive_format, volume_size) + tuple(item['id'] for item in favorites)
+    archive_path = get_archive_path(archive_key, archive_format)
+    volume_count = len(plan_volumes(favorites, volume_size))
+    prepared = prepared_archives.get(kind)
+    ready = (
+        prepared is not None and prepared[0] == archive_key
+        and all(os.path.exists(path) for path in prepared[1])
+    )
+    
+    building = archive_jobs.get(kind)
+    if building is not None and building[0] != archive_key:
+        # Список файлов или параметры изменились - собираемый архив больше не нужен
+        building[1].cancel()
+        del archive_jobs[kind]
+        building = None
+    
+    if building is not None:
+        job = building[1]
+        if job.running():
+            if job.queued:
+                # Сервер занят другими задачами - сборка начнется сама, как только освободятся квоты
+                st.info(f"Сборка архива: {describe_queue(job).lower()}")
+            else:
+                st.progress(job.progress(), text=f"Создание архива: {job.done_count} из {job.total_count}")
+            if st.button("Отменить", key=f"cancel_archive_{kind}", use_container_width=True):
+                # Уже скачанные файлы и собранные тома остаются, сборку можно будет продолжить
+                job.cancel()
+                del archive_jobs[kind]
+                st.rerun()
+            if job.outputs:
+                # Готовые тома можно скачивать, пока собирается следующий
+                render_volume_downloads(list(job.outputs), volume_count, kind, archive_format)
+                if get_media_server() is None:
+                    # st.download_button заново читает тома с диска при каждом обновлении,
+                    # поэтому автообновление страницы на это время выключается
+                    st.session_state.hold_refresh = True
+                    st.button("Обновить прогресс", key=f"refresh_archive_{kind}", use_container_width=True)
+            return
+        
+        del archive_jobs[kind]
+        paths = job.result()
+        if paths is not None:
+            # Предыдущий архив больше не нужен
+            if prepared:
+                for path in prepared[1]:
+                    if path not in paths:
+                        remove_archive(path)
+            prepared_archives[kind] = (archive_key, paths)
+            ready = True
+        elif job.error() is not None:
+            metrics.inc('telegram_errors_total')
+            st.error(f"Ошибка при создании архива: {str(job.error())}")
+    
+    if not ready:
+        # Если прошлая сборка прервалась, уже скачанные файлы и собранные тома не качаются заново
+        first_volume = get_volume_path(archive_path, 0, volume_count)
+        if os.path.exists(get_manifest_path(first_volume)) or (volume_count > 1 and os.path.exists(first_volume)):
+            label = "Продолжить подготовку архива"
+        else:
+            label = prepare_label
+        # Размер известен заранее из индекса; повторно сохраненные файлы попадают в архив один раз
+        label += f" (~{format_size(estimate_archive_size(favorites))}"
+        if volume_count > 1:
+            label += f", томов: {volume_count}"
+        label += ")"
+        if st.button(label, key=f"prepare_archive_{kind}", use_container_width=True):
+            size = estimate_archive_size(favorites)
+            admission = get_client_pool().admission
+            if admission.allow_archive(get_client_key(), get_archive_label(favorites), size):
+                job = start_archive_build(favorites, archive_path, archive_format, volume_size)
+                archive_jobs[kind] = (archive_key, job)
+                st.rerun()
+            st.error(
+                f"Архив слишком большой: ~{format_size(size)} при ограничении {format_size(admission.archive_bytes)}. "
+                "Выберите меньше файлов или сузьте фильтр."
+            )
+    
+    if ready:
+        render_volume_downloads(prepared_archives[kind][1], volume_count, kind, archive_format)
+
+# Все фоновые задачи текущей сессии
+def get_session_jobs():
+    jobs = list(st.session_state.get('file_jobs', {}).values())
+    jobs += [job for _, job in st.session_state.get('archive_jobs', {}).values()]
+    if 'favorites_job' in st.session_state:
+        jobs.append(st.session_state.favorites_job)
+    return jobs
+
+# Есть ли у текущей сессии незавершенные фоновые задачи
+def has_running_jobs():
+    return any(job.running() for job in get_session_jobs())
+
+# Выбранные файлы: id сообщений
+def get_selected_ids():
+    return st.session_state.setdefault('selected_ids', set())
+
+# Отметить или снять отметку с файла (по флажку в сетке)
+def toggle_selection(item_id):
+    selected = get_selected_ids()
+    if st.session_state[f"select_{item_id}"]:
+        selected.add(item_id)
+    else:
+        selected.discard(item_id)
+
+# Заменить выбор на ids; флажки сетки берут новое значение из выбора при следующей отрисовке
+def set_selection(ids):
+    st.session_state.selected_ids = set(ids)
+    for key in list(st.session_state.keys()):
+        if key.startswith("select_"):
+            del st.session_state[key]
+
+# Выбор файлов и архив только из выбранных
+def render_selection(all_favorites, favorites, archive_format, volume_size):
+    selected = get_selected_ids()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button(
+            f"Выбрать все по фильтру ({len(favorites)})", use_container_width=True,
+            on_click=set_selection, args=(selected | {item['id'] for item in favorites},)
+        )
+    with col2:
+        st.button(
+            "Снять выбор", use_container_width=True, disabled=not selected,
+            on_click=set_selection, args=(set(),)
+        )
+    
+    # Выбор хранится по id и не сбрасывается при смене фильтров и страниц
+    chosen = [item for item in all_favorites if item['id'] in selected]
+    if chosen:
+        st.write(f"Выбрано файлов: {len(chosen)}, примерно {format_size(estimate_archive_size(chosen))}")
+        render_archive_download(chosen, "selected", archive_format, volume_size)
+
+# Фильтры списка по типу, дате и размеру; возвращает словарь для filter_media
+def render_media_filters():
+    with st.expander("Фильтры"):
+        media_types = st.multiselect(
+            "Тип",
+            options=list(MEDIA_TYPE_LABELS),
+            format_func=MEDIA_TYPE_LABELS.get,
+            key="filter_types"
+        )
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            date_from = st.date_input("С даты", value=None, format="DD.MM.YYYY", key="filter_date_from")
+        with col2:
+            date_to = st.date_input("По дату", value=None, format="DD.MM.YYYY", key="filter_date_to")
+        with col3:
+            min_size = st.number_input("От, МБ", min_value=0.0, value=None, key="filter_min_size")
+        with col4:
+            max_size = st.number_input("До, МБ", min_value=0.0, value=None, key="filter_max_size")
+    
+    return {
+        'types': media_types,
+        'date_from': date_from,
+        'date_to': date_to,
+        'min_size': int(min_size * 1024 * 1024) if min_size is not None else None,
+        'max_size': int(max_size * 1024 * 1024) if max_size is not None else None,
+    }
+
+# Перейти на страницу с файлами за выбранную дату (список отсортирован от новых к старым)
+def jump_to_date(favorites, page_size):
+    day = st.session_state.jump_date
+    if day is None or not favorites:
+        return
+    index = next(
+        (i for i, item in enumerate(favorites) if item['date'][:10] <= day.isoformat()),
+        len(favorites) - 1
+    )
+    st.session_state.page_number = index // page_size + 1
+
+# Переключатель страниц списка; возвращает файлы текущей страницы
+def render_pagination(favorites):
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        page_size = st.selectbox(
+            "Файлов на странице", PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE), key="page_size"
+        )
+    page_count = max(1, (len(favorites) + page_size - 1) // page_size)
+    # После смены фильтров или размера страницы номер может оказаться за концом списка
+    if st.session_state.get('page_number', 1) > page_count:
+        st.session_state.page_number = page_count
+    with col2:
+        page = st.number_input("Страница", min_value=1, step=1, key="page_number")
+    with col3:
+        st.date_input(
+            "Перейти к дате", value=None, format="DD.MM.YYYY", key="jump_date",
+            on_change=jump_to_date, args=(favorites, page_size)
+        )
+    page = min(page, page_count)
+    st.caption(f"Страница {page} из {page_count}")
+    
+    start = (page - 1) * page_size
+    return favorites[start:start + page_size]
+
 # Страница с избранными медиа
 def dashboard_page():
     st.title("Ваши избранные медиа")
@@ -311,6 +754,15 @@ def dashboard_page():
     col1, col2 = st.columns([6, 1])
     with col2:
         if st.button("Выйти", key="logout"):
+            # Останавливаем загрузки, закрываем соединение с Telegram и удаляем индекс до очистки сессии
+            cancel_session_jobs()
+            release_client()
+            remove_session_archives()
+            if 'user_id' in st.session_state:
+                # Скачанные файлы и миниатюры пользователя не остаются в кэше на сервере
+                remove_cached_media(get_media_cache(), load_media_index(st.session_state.user_id))
+                get_favorites_cache().invalidate(st.session_state.user_id)
+                clear_media_index(st.session_state.user_id)
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             st.session_state.page = "main"
@@ -318,199 +770,264 @@ def dashboard_page():
     
     # Получаем избранные медиа
     with st.spinner("Загрузка ваших избранных медиафайлов..."):
-        favorites = get_favorites()
+        all_favorites = get_favorites()
+    
+    # Фильтры применяются к локальному индексу, запросов к Telegram они не требуют
+    filters = render_media_filters()
+    favorites = filter_media(all_favorites, filters)
     
     if favorites:
-        # Кнопка для скачивания всех файлов
-        if st.download_button(
-            label="Скачать все файлы (ZIP)",
-            data=get_all_media_zip(favorites),
-            file_name="telegram_favorites.zip",
-            mime="application/zip",
-            use_container_width=True
-        ):
-            st.success("Скачивание началось!")
+        if len(favorites) < len(all_favorites):
+            st.caption(f"Показано {len(favorites)} из {len(all_favorites)} файлов")
+        
+        # Кнопка для скачивания всех подходящих файлов
+        archive_format, volume_size = render_archive_options()
+        render_archive_download(favorites, "all", archive_format, volume_size)
+        
+        # Выбор отдельных файлов для архива
+        render_selection(all_favorites, favorites, archive_format, volume_size)
             
         # Отображаем медиафайлы в сетке
         st.write("### Список медиафайлов:")
         
-        # Используем 3 колонки для отображения
-        cols_per_row = 3
-        for i in range(0, len(favorites), cols_per_row):
+        # Виджеты создаются только для текущей страницы, поэтому страница не тяжелеет с ростом избранного
+        page_items = render_pagination(favorites)
+        
+        # Миниатюры для показанных файлов загружаются одним пакетом
+        previews = get_previews(page_items)
+        
+        cols_per_row = GRID_COLUMNS
+        for i in range(0, len(page_items), cols_per_row):
             cols = st.columns(cols_per_row)
             for j in range(cols_per_row):
-                if i + j < len(favorites):
-                    item = favorites[i + j]
+                if i + j < len(page_items):
+                    item = page_items[i + j]
                     with cols[j]:
                         with st.container(border=True):
+                            if item['id'] in previews:
+                                st.image(previews[item['id']], use_column_width=True)
                             st.write(f"**Тип:** {item['type']}")
                             st.write(f"**Дата:** {item['date']}")
                             st.write(f"**Файл:** {item['filename']}")
+                            st.checkbox(
+                                "Выбрать",
+                                value=item['id'] in get_selected_ids(),
+                                key=f"select_{item['id']}",
+                                on_change=toggle_selection,
+                                args=(item['id'],)
+                            )
+                            
+                            if get_media_server() is not None and item['type'] in STREAM_MEDIA_TYPES:
+                                render_player(item)
                             
                             # Кнопка скачивания для каждого файла
-                            media_data = get_media_data(item['id'])
-                            if media_data:
-                                st.download_button(
-                                    label="Скачать",
-                                    data=media_data,
-                                    file_name=item['filename'],
-                                    key=f"download_{item['id']}"
-                                )
-    else:
+                            render_file_download(item)
+    elif all_favorites:
+        st.info("Нет файлов, подходящих под фильтры.")
+    elif 'favorites_job' not in st.session_state:
+        # Пока список загружается, о пустом избранном говорить рано
         st.info("У вас нет избранных медиафайлов или произошла ошибка при их загрузке.")
         st.write("Добавьте медиафайлы в избранное в Telegram и обновите страницу.")
     
     st.divider()
     st.caption("Этот сервис использует Telegram API и не связан с Telegram Inc.")
+    
+    # Пока идут фоновые задачи, периодически обновляем страницу, чтобы показать прогресс
+    if has_running_jobs() and not st.session_state.pop('hold_refresh', False):
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
 
 # Получить все избранные медиафайлы
 def get_favorites():
     try:
         if 'session_string' not in st.session_state:
             return []
-            
-        # Создаем клиент с сохраненной сессией
-        client = create_client()
         
-        # Получаем избранные сообщения через API
-        async def fetch_favorites():
-            try:
-                await client.connect()
-                
-                if not await client.is_user_authorized():
-                    await client.disconnect()
-                    return []
-                
-                favorites = []
-                
-                # Вместо GetSavedDialogsRequest используем альтернативный подход
-                # Получаем сообщения из "Сохраненные сообщения" (Saved Messages)
-                # В Telegram это диалог с самим собой
-                messages = await client.get_messages('me', limit=200)
-                
-                # Отбираем только медиафайлы
-                for message in messages:
-                    if message.media:
-                        # Добавляем информацию о медиа
-                        media_info = {
-                            'id': message.id,
-                            'date': message.date.strftime('%Y-%m-%d %H:%M:%S'),
-                            'type': get_media_type(message),
-                            'filename': get_filename(message)
-                        }
-                        favorites.append(media_info)
-                
-                await client.disconnect()
+        user_id = st.session_state.get('user_id')
+        favorites_cache = get_favorites_cache()
+        
+        # Пока список свежий, перезапуски страницы не обращаются к Telegram
+        if user_id is not None:
+            favorites = favorites_cache.get(user_id)
+            if favorites is not None:
                 return favorites
-            except Exception as e:
-                if client.is_connected():
-                    await client.disconnect()
-                st.error(f"Ошибка при получении избранных: {str(e)}")
-                return []
         
-        return run_async(fetch_favorites())
+        # Получаем избранные сообщения через API
+        async def fetch(client, job):
+            if not await client.is_user_authorized():
+                return user_id, None
+            
+            current_user_id = user_id
+            if current_user_id is None:
+                current_user_id = (await client.get_me()).id
+            
+            favorites = await fetch_favorites(client, current_user_id, lambda seen: job.update(seen, 0))
+            favorites_cache.put(current_user_id, favorites)
+            # Новые и удаленные сообщения попадают в список сразу, не дожидаясь истечения TTL
+            favorites_cache.watch(client, current_user_id)
+            return current_user_id, favorites
+        
+        # Первая синхронизация длинной истории может идти долго, поэтому она выполняется фоновой задачей
+        # без ограничения по времени, а страница показывает прогресс и уже записанную часть индекса
+        job = st.session_state.get('favorites_job')
+        if job is None:
+            job = st.session_state.favorites_job = submit_with_client(fetch, 0, "загрузка списка избранного")
+        # Обычная дозагрузка новых сообщений занимает секунды - ее страница дожидается сразу
+        concurrent.futures.wait([job.future], FAVORITES_WAIT)
+        if job.running():
+            if job.queued:
+                st.info(f"Загрузка списка избранного: {describe_queue(job).lower()}")
+            else:
+                st.info(f"Загрузка списка избранного: просмотрено сообщений {job.done_count}")
+            return load_media_index(user_id) if user_id is not None else []
+        
+        del st.session_state.favorites_job
+        if job.error() is not None:
+            raise job.error()
+        if job.result() is None:
+            return []
+        user_id, favorites = job.result()
+        if favorites is None:
+            return []
+        st.session_state.user_id = user_id
+        return favorites
     except Exception as e:
+        metrics.inc('telegram_errors_total')
         st.error(f"Ошибка при получении избранных: {str(e)}")
         return []
 
-# Получить данные одного медиафайла
-def get_media_data(message_id):
-    try:
-        if 'session_string' not in st.session_state:
+# Запустить фоновую загрузку одного медиафайла во временный файл на диске
+def start_media_download(item):
+    message_id = item['id']
+    cache = get_media_cache()
+    path = os.path.join(get_archive_dir(), f"{ARCHIVE_FILE_PREFIX}{get_client_key()}_file_{message_id}")
+    
+    async def download_media(client, job):
+        if not await client.is_user_authorized():
             return None
-            
-        # Создаем клиент с сохраненной сессией
-        client = create_client()
-        
-        # Скачиваем файл через API
-        async def download_media():
-            try:
-                await client.connect()
-                
-                if not await client.is_user_authorized():
-                    await client.disconnect()
-                    return None
-                
-                # Получаем сообщение с медиа - аргумент ids возвращает один объект, а не список
-                message = await client.get_messages('me', ids=message_id)
-                
-                # Проверяем, что сообщение существует и содержит медиа
-                if not message or not message.media:
-                    await client.disconnect()
-                    return None
-                
-                file_buffer = io.BytesIO()
-                
-                # Скачиваем файл в буфер
-                await client.download_media(message, file_buffer)
-                
-                file_buffer.seek(0)
-                result = file_buffer.read()
-                
-                await client.disconnect()
-                return result
-            except Exception as e:
-                if client.is_connected():
-                    await client.disconnect()
-                st.error(f"Ошибка при скачивании: {str(e)}")
-                return None
         
-        return run_async(download_media())
-    except Exception as e:
-        st.error(f"Ошибка при скачивании: {str(e)}")
-        return None
+        if not await save_media(client, message_id, path, cache, on_progress=job.update):
+            return None
+        return path
+    
+    return submit_with_client(download_media, item['size'] or 0, "скачивание файла")
 
-# Получить все медиафайлы в ZIP-архиве
-def get_all_media_zip(favorites):
+# Получить миниатюры для файлов страницы: из кэша, недостающие - одним пакетом из Telegram
+def get_previews(items):
     try:
         if 'session_string' not in st.session_state:
-            return None
-            
-        # Создаем клиент с сохраненной сессией
-        client = create_client()
+            return {}
         
-        # Создаем ZIP архив с медиафайлами
-        async def download_all_media():
-            try:
-                await client.connect()
-                
-                if not await client.is_user_authorized():
-                    await client.disconnect()
-                    return None
-                
-                memory_file = io.BytesIO()
-                with zipfile.ZipFile(memory_file, 'w') as zf:
-                    for item in favorites:
-                        message_id = item['id']
-                        filename = item['filename']
-                        
-                        # Получаем сообщение - аргумент ids возвращает один объект, а не список
-                        message = await client.get_messages('me', ids=message_id)
-                        
-                        # Проверяем, что сообщение существует и содержит медиа
-                        if message and message.media:
-                            file_buffer = io.BytesIO()
-                            
-                            # Скачиваем файл
-                            await client.download_media(message, file_buffer)
-                            
-                            # Добавляем в архив
-                            file_buffer.seek(0)
-                            zf.writestr(filename, file_buffer.read())
-                
-                await client.disconnect()
-                memory_file.seek(0)
-                return memory_file.getvalue()
-            except Exception as e:
-                if client.is_connected():
-                    await client.disconnect()
-                st.error(f"Ошибка при создании архива: {str(e)}")
-                return None
+        cache = get_media_cache()
+        # Файлы без миниатюр запоминаем, чтобы не запрашивать их на каждом перезапуске
+        no_preview_ids = st.session_state.setdefault('no_preview_ids', set())
+        previews = {}
+        missing = []
+        
+        for item in items:
+            key = preview_cache_key(item)
+            if key is None or not has_preview(item) or item['id'] in no_preview_ids:
+                continue
+            path = cache.get(key)
+            if path is not None:
+                with open(path, 'rb') as preview_file:
+                    previews[item['id']] = preview_file.read()
+            else:
+                missing.append(item)
+        
+        if not missing:
+            return previews
+        
+        # Скачиваем недостающие миниатюры параллельно
+        async def download_previews(client):
+            if not await client.is_user_authorized():
+                return {}, []
+            
+            return await fetch_previews(client, missing, cache)
         
-        return run_async(download_all_media())
+        try:
+            fetched, without_preview = run_with_client(download_previews)
+        except Exception:
+            # Страница обновляется каждую секунду, пока идут задачи, - не повторяем неудачный запрос
+            # на каждом обновлении: файлы этой страницы остаются без миниатюр
+            no_preview_ids.update(item['id'] for item in missing)
+            raise
+        no_preview_ids.update(without_preview)
+        previews.update(fetched)
+        return previews
     except Exception as e:
-        st.error(f"Ошибка при создании архива: {str(e)}")
-        return None
+        metrics.inc('telegram_errors_total')
+        st.error(f"Ошибка при загрузке миниатюр: {str(e)}")
+        return {}
+
+# Запустить фоновую сборку архива с медиафайлами в archive_path на диске (томами, если задан volume_size)
+# Задача возвращает список путей томов; готовые тома появляются в job.outputs до ее завершения
+# При ошибке или отмене недособранный том и его манифест остаются, повторный запуск продолжит сборку
+def start_archive_build(favorites, archive_path, archive_format="zip", volume_size=None):
+    cache = get_media_cache()
+    archive_dir = get_archive_dir()
+    
+    async def download_all_media(client, job):
+        if not await client.is_user_authorized():
+            return None
+        
+        # Архив пишется сразу на диск, в памяти держится только текущий блок
+        remove_stale_archives(archive_dir, ARCHIVE_FILE_PREFIX)
+        return await write_volumes(
+            client, favorites, archive_path, cache,
+            on_progress=job.update,
+            on_volume=lambda index, path: job.add_output(path),
+            volume_size=volume_size,
+            archive_format=archive_format
+        )
+    
+    return submit_with_client(download_all_media, estimate_archive_size(favorites), get_archive_label(favorites))
+
+# Описание сборки архива для администратора (без имен файлов пользователя)
+def get_archive_label(favorites):
+    return f"сборка архива ({len(favorites)} файлов)"
+
+# Страница администратора: метрики процесса
+def admin_page():
+    st.title("Метрики")
+    
+    rows = []
+    for name, kind, values in metrics.snapshot():
+        row = {'Метрика': name, 'Тип': kind}
+        row.update(values)
+        if kind == 'summary' and values['count']:
+            row['avg'] = values['sum'] / values['count']
+        rows.append(row)
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    
+    with st.expander("Формат Prometheus"):
+        st.code(metrics.render(), language="text")
+    
+    # Квоты и очередь фоновых задач
+    st.subheader("Квоты")
+    quotas = get_client_pool().admission.snapshot()
+    limits = quotas['limits']
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Задачи", f"{len(quotas['running'])} из {limits['total_jobs']}")
+    col2.metric("В очереди", len(quotas['queue']))
+    col3.metric("Загрузки", f"{format_size(quotas['running_bytes'])} из {format_size(limits['total_bytes'])}")
+    col4.metric("Соединения", f"{quotas['connections']} из {limits['clients']}")
+    st.caption(
+        f"На сессию: задач {limits['session_jobs']}, загрузок {format_size(limits['session_bytes'])}; "
+        f"архив не больше {format_size(limits['archive_bytes']) if limits['archive_bytes'] else 'без ограничения'}; "
+        f"соединений ждут: {quotas['waiting_connections']}"
+    )
+    if quotas['running']:
+        st.write("Выполняются")
+        st.dataframe(quotas['running'], use_container_width=True, hide_index=True)
+    if quotas['queue']:
+        st.write("Очередь")
+        st.dataframe(quotas['queue'], use_container_width=True, hide_index=True)
+    with st.expander("Журнал допуска"):
+        st.dataframe(quotas['log'], use_container_width=True, hide_index=True)
+    
+    if st.button("Обновить"):
+        st.rerun()
 
 # Применяем стили
 def apply_custom_styles():
@@ -544,8 +1061,13 @@ if 'page' not in st.session_state:
 # Применяем стили
 apply_custom_styles()
 
+if METRICS_PORT:
+    get_metrics_server()
+
 # Маршрутизация страниц
-if st.session_state.page == "main":
+if ADMIN_TOKEN and st.query_params.get("admin") == ADMIN_TOKEN:
+    admin_page()
+elif st.session_state.page == "main":
     main_page()
 elif st.session_state.page == "login":
     login_page()
@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+from datetime import date
+import logging
+import os
+import shutil
+import sys
+from telethon.sessions import StringSession
+from favorites_core import (
+    DEFAULT_API_ID, DEFAULT_API_HASH, ARCHIVE_CONCURRENCY, MULTIPART_CONCURRENCY,
+    MEDIA_SEARCH_FILTERS, ScheduledTelegramClient, get_media_info, get_media_key, iter_favorite_messages,
+    write_media_resumable,
+)
+
+# Экспорт медиа из избранного Telegram в каталог без веб-интерфейса (например, из cron):
+#   python export.py --session "$TG_SESSION" --output ./telegram_favorites
+#   python export.py --session "$TG_SESSION" --output ./photos --type photo --since 2024-05-01 --until 2024-05-31
+# Файлы раскладываются по каталогам <тип>/<год-месяц>/<id сообщения>_<имя файла>,
+# уже скачанные файлы нужного размера пропускаются, недокачанные (.part) докачиваются,
+# а одно и то же медиа, сохраненное несколько раз, скачивается один раз и связывается жесткой ссылкой
+
+log = logging.getLogger("export")
+
+
+# Путь файла в каталоге экспорта
+def get_export_path(output_dir, item):
+    # Имя из атрибутов документа может содержать разделители каталогов
+    filename = item['filename'].replace('/', '_').replace('\\', '_')
+    # Дата в индексе хранится как '%Y-%m-%d %H:%M:%S'
+    month = item['date'][:7]
+    return os.path.join(output_dir, item['type'], month, f"{item['id']}_{filename}")
+
+# Скачать одно медиа в каталог экспорта, если его там еще нет
+async def export_message(client, message, output_dir, part_concurrency):
+    item = get_media_info(message)
+    path = get_export_path(output_dir, item)
+
+    if item['size'] is not None and os.path.exists(path) and os.path.getsize(path) == item['size']:
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Пишем во временный файл, чтобы прерванная загрузка не выглядела готовой;
+    # при следующем запуске загрузка продолжится с его конца
+    temp_path = path + '.part'
+    with open(temp_path, 'ab') as out:
+        await write_media_resumable(client, message, out, part_concurrency)
+    os.replace(temp_path, path)
+    log.info("Скачан %s", path)
+    return True
+
+# Выгрузить копию уже выгруженного файла source без скачивания
+# Жесткая ссылка не занимает места, если файловая система ее не поддерживает - копируем
+def export_copy(source, output_dir, item):
+    path = get_export_path(output_dir, item)
+    if os.path.exists(path) and os.path.getsize(path) == os.path.getsize(source):
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+    log.info("Копия %s -> %s", source, path)
+    return True
+
+# Выгрузить медиа из избранного, подходящие под filters, в output_dir
+async def export_favorites(client, output_dir, concurrency, part_concurrency, filters=None):
+    slots = asyncio.Semaphore(concurrency)
+    stats = {'downloaded': 0, 'copied': 0, 'skipped': 0, 'failed': 0}
+    # Ключ медиа -> future с путем файла, выгруженного из первого сообщения с этим медиа
+    originals = {}
+
+    async def export(message):
+        item = get_media_info(message)
+        key = get_media_key(item)
+        original = originals.get(key) if key is not None else None
+        exported = None
+        if key is not None and original is None:
+            exported = originals[key] = asyncio.get_running_loop().create_future()
+        path = None
+        try:
+            # Копия ждет первое сообщение вне слота, чтобы не занимать его впустую
+            source = await original if original is not None else None
+            if source is not None:
+                if export_copy(source, output_dir, item):
+                    stats['copied'] += 1
+                else:
+                    stats['skipped'] += 1
+                return
+            async with slots:
+                if await export_message(client, message, output_dir, part_concurrency):
+                    stats['downloaded'] += 1
+                else:
+                    stats['skipped'] += 1
+            path = get_export_path(output_dir, item)
+        except Exception as e:
+            stats['failed'] += 1
+            log.error("Ошибка при скачивании сообщения %s: %s", message.id, e)
+        finally:
+            # Если первое сообщение не выгрузилось, копии скачиваются сами
+            if exported is not None:
+                exported.set_result(path)
+
+    tasks = set()
+    # Сообщения отбираются на стороне Telegram, iter_messages сам идет по страницам (по 100 сообщений за запрос)
+    async for message in iter_favorite_messages(client, filters):
+        # Не держим в памяти больше задач, чем нужно для параллельной загрузки
+        if len(tasks) >= concurrency * 2:
+            _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        tasks.add(asyncio.ensure_future(export(message)))
+    if tasks:
+        await asyncio.wait(tasks)
+
+    return stats
+
+async def main(args):
+    # Запросы ограничиваются тем же планировщиком, что и в веб-приложении, FloodWait пережидается
+    client = ScheduledTelegramClient(StringSession(args.session), args.api_id, args.api_hash, account='export')
+    await client.connect()
+    try:
+        if not await client.is_user_authorized():
+            log.error("Сессия не авторизована")
+            return 2
+
+        filters = {
+            'types': args.type,
+            'date_from': args.since,
+            'date_to': args.until,
+            'min_size': int(args.min_size * 1024 * 1024) if args.min_size is not None else None,
+            'max_size': int(args.max_size * 1024 * 1024) if args.max_size is not None else None,
+        }
+        stats = await export_favorites(
+            client, args.output, args.concurrency, args.part_concurrency, filters
+        )
+        log.info(
+            "Готово: скачано %d, копий %d, пропущено %d, ошибок %d",
+            stats['downloaded'], stats['copied'], stats['skipped'], stats['failed']
+        )
+        return 1 if stats['failed'] else 0
+    finally:
+        await client.disconnect()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Экспорт медиа из избранного Telegram в каталог")
+    parser.add_argument(
+        "--session", default=os.environ.get("TG_SESSION"),
+        help="строка StringSession (по умолчанию из переменной TG_SESSION)"
+    )
+    parser.add_argument("--output", required=True, help="каталог для экспорта")
+    parser.add_argument("--api-id", type=int, default=int(os.environ.get("API_ID", DEFAULT_API_ID)))
+    parser.add_argument("--api-hash", default=os.environ.get("API_HASH", DEFAULT_API_HASH))
+    parser.add_argument(
+        "--concurrency", type=int, default=ARCHIVE_CONCURRENCY,
+        help="сколько файлов скачивать одновременно"
+    )
+    parser.add_argument(
+        "--part-concurrency", type=int, default=MULTIPART_CONCURRENCY,
+        help="сколько частей одного большого файла скачивать одновременно"
+    )
+    parser.add_argument(
+        "--type", action="append", choices=sorted(MEDIA_SEARCH_FILTERS),
+        help="выгружать только этот тип медиа (можно указать несколько раз)"
+    )
+    parser.add_argument("--since", type=date.fromisoformat, help="начиная с даты ГГГГ-ММ-ДД (UTC)")
+    parser.add_argument("--until", type=date.fromisoformat, help="по дату ГГГГ-ММ-ДД включительно (UTC)")
+    parser.add_argument("--min-size", type=float, help="минимальный размер файла, МБ")
+    parser.add_argument("--max-size", type=float, help="максимальный размер файла, МБ")
+    args = parser.parse_args(argv)
+    if not args.session:
+        parser.error("нужна строка сессии: --session или переменная TG_SESSION")
+    return args
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,243 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from telethon.tl import types
+
+# Имитация Telegram для бенчмарков и проверки без аккаунта:
+# FakeTelegramClient повторяет ту часть TelegramClient, которой пользуется favorites_core,
+# а FakeTelegramBackend генерирует избранное с медиа заданного количества и размера
+# и имитирует задержку ответа и пропускную способность соединения
+
+FAKE_USER_ID = 777000001  # id пользователя, от имени которого работает имитация
+FAKE_PAGE_SIZE = 100  # сообщений за один запрос при обходе истории, как у Telegram
+FAKE_PREVIEW_SIZE = 8 * 1024  # байт одной миниатюры
+FAKE_PATTERN_SIZE = 1024 * 1024  # байт случайных данных, из которых нарезается содержимое файлов
+
+
+class FakeTelegramBackend:
+    # count - сколько сообщений с медиа в избранном; каждое large_every-е - большой документ размером large_size,
+    # остальные по очереди фото (photo_size байт) и документы (document_size байт)
+    # каждое duplicate_every-е - повторно сохраненное медиа из предыдущего сообщения с медиа
+    # latency - секунд задержки на каждый запрос; bandwidth - байт в секунду на один запрос (None - без ограничения)
+    def __init__(self, count=100, photo_size=200 * 1024, document_size=2 * 1024 * 1024,
+                 large_size=64 * 1024 * 1024, large_every=0, duplicate_every=0, latency=0.05, bandwidth=None,
+                 text_every=5, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0  # сколько запросов получил «сервер»
+        self.bytes_sent = 0  # сколько байт медиа отдано
+        rng = random.Random(seed)
+        self._pattern = bytes(rng.getrandbits(8) for _ in range(FAKE_PATTERN_SIZE))
+
+        self.messages = {}
+        started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        message_id = 0
+        for index in range(count):
+            # Между сообщениями с медиа встречаются текстовые, как в настоящем избранном
+            if text_every and index % text_every == 0:
+                message_id += 1
+                self.messages[message_id] = self._make_text(message_id, started)
+            message_id += 1
+            if duplicate_every and index and (index + 1) % duplicate_every == 0:
+                message = self._make_copy(message_id, started, message)
+            elif large_every and (index + 1) % large_every == 0:
+                message = self._make_document(message_id, started, large_size, video=True)
+            elif index % 2 == 0:
+                message = self._make_photo(message_id, started, photo_size)
+            else:
+                message = self._make_document(message_id, started, document_size)
+            self.messages[message_id] = message
+
+        # Поиск сообщения по фото или документу для iter_download (у копий - первое сообщение)
+        self._by_media_id = {}
+        for message in self.messages.values():
+            if message.media:
+                self._by_media_id.setdefault(message.media.id, message)
+
+    def _make_text(self, message_id, started):
+        return SimpleNamespace(
+            id=message_id, date=started + timedelta(hours=message_id), media=None, file=None,
+            photo=None, document=None, video=None, audio=None, voice=None,
+        )
+
+    def _make_photo(self, message_id, started, size):
+        photo = SimpleNamespace(
+            id=10 ** 9 + message_id,
+            sizes=[SimpleNamespace(type='s'), SimpleNamespace(type='m'), SimpleNamespace(type='y')],
+        )
+        return SimpleNamespace(
+            id=message_id, date=started + timedelta(hours=message_id), media=photo,
+            photo=photo, document=None, video=None, audio=None, voice=None,
+            file=SimpleNamespace(size=size, name=None, mime_type='image/jpeg', ext='.jpg'),
+        )
+
+    def _make_document(self, message_id, started, size, video=False):
+        filename = f"video_{message_id}.mp4" if video else f"document_{message_id}.bin"
+        document = SimpleNamespace(
+            id=2 * 10 ** 9 + message_id,
+            attributes=[types.DocumentAttributeFilename(file_name=filename)],
+            thumbs=[SimpleNamespace(type='m')] if video else None,
+        )
+        mime_type = 'video/mp4' if video else 'application/octet-stream'
+        return SimpleNamespace(
+            id=message_id, date=started + timedelta(hours=message_id), media=document,
+            photo=None, document=document, video=document if video else None, audio=None, voice=None,
+            file=SimpleNamespace(size=size, name=filename, mime_type=mime_type, ext=filename[-4:]),
+        )
+
+    # Сообщение с тем же фото или документом, что и у original
+    def _make_copy(self, message_id, started, original):
+        return SimpleNamespace(
+            id=message_id, date=started + timedelta(hours=message_id), media=original.media,
+            photo=original.photo, document=original.document, video=original.video,
+            audio=None, voice=None, file=original.file,
+        )
+
+    # Сымитировать один запрос, возвращающий size байт
+    async def request(self, size=0):
+        self.requests += 1
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Содержимое медиа с message_id: байты с offset длиной length
+    def read(self, message_id, offset, length):
+        size = self.messages[message_id].file.size
+        length = max(0, min(length, size - offset))
+        # Смещаем шаблон на id медиа, чтобы разные файлы различались, а копии совпадали
+        start = (offset + self.messages[message_id].media.id * 4099) % FAKE_PATTERN_SIZE
+        data = bytearray()
+        while len(data) < length:
+            piece = self._pattern[start:start + length - len(data)]
+            data.extend(piece)
+            start = 0
+        return bytes(data)
+
+    # Сообщение с медиа-объектом source (фото или документ)
+    def find_by_media(self, source):
+        return self._by_media_id[source.id]
+
+    # Сколько сообщений с медиа и сколько в них байт (копии считаются отдельно)
+    def totals(self):
+        media = [message for message in self.messages.values() if message.media]
+        return len(media), sum(message.file.size for message in media)
+
+
+# Поток блоков файла, как у TelegramClient.iter_download
+class FakeDownloadIter:
+    def __init__(self, backend, message_id, offset, request_size, limit):
+        self.backend = backend
+        self.message_id = message_id
+        self.offset = offset
+        self.request_size = request_size
+        self.remaining = limit
+        self.size = backend.messages[message_id].file.size
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed or self.offset >= self.size or self.remaining == 0:
+            raise StopAsyncIteration
+        chunk = self.backend.read(self.message_id, self.offset, self.request_size)
+        await self.backend.request(len(chunk))
+        self.backend.bytes_sent += len(chunk)
+        self.offset += len(chunk)
+        if self.remaining is not None:
+            self.remaining -= 1
+        return chunk
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeTelegramClient:
+    def __init__(self, backend, user_id=FAKE_USER_ID):
+        self.backend = backend
+        self.user_id = user_id
+        self.connected = False
+        self.session = SimpleNamespace(save=lambda: '')
+        self.event_handlers = []
+
+    async def connect(self):
+        await self.backend.request()
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self):
+        await self.backend.request()
+        return SimpleNamespace(id=self.user_id)
+
+    # Любой «сырой» запрос (например, PingRequest) просто занимает один обмен с сервером
+    async def __call__(self, request):
+        await self.backend.request()
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.event_handlers.append((callback, event))
+
+    async def get_messages(self, entity, limit=None, ids=None, **kwargs):
+        await self.backend.request()
+        if ids is None:
+            message_ids = sorted(self.backend.messages, reverse=True)[:limit]
+            return [self.backend.messages[message_id] for message_id in message_ids]
+        if isinstance(ids, list):
+            return [self.backend.messages.get(message_id) for message_id in ids]
+        return self.backend.messages.get(ids)
+
+    # filter - фильтр поиска Telegram (фото, видео, документы), offset_date - только сообщения раньше этой даты,
+    # offset_id - только сообщения с меньшим номером
+    async def iter_messages(self, entity, min_id=0, filter=None, offset_date=None, offset_id=0, **kwargs):
+        messages = [
+            message for message_id, message in sorted(self.backend.messages.items(), reverse=True)
+            if message_id > min_id and (not offset_id or message_id < offset_id)
+            and (offset_date is None or message.date < offset_date)
+        ]
+        if isinstance(filter, types.InputMessagesFilterPhotos):
+            messages = [message for message in messages if message.photo]
+        elif isinstance(filter, types.InputMessagesFilterVideo):
+            messages = [message for message in messages if message.video]
+        elif isinstance(filter, types.InputMessagesFilterDocument):
+            messages = [message for message in messages if message.document]
+        elif filter is not None:
+            messages = [message for message in messages if message.audio or message.voice]
+        for index, message in enumerate(messages):
+            # Telegram отдает историю страницами
+            if index % FAKE_PAGE_SIZE == 0:
+                await self.backend.request()
+            yield message
+
+    def iter_download(self, file, offset=0, request_size=512 * 1024, limit=None, file_size=None, **kwargs):
+        message = self.backend.find_by_media(file)
+        return FakeDownloadIter(self.backend, message.id, offset, request_size, limit)
+
+    async def download_media(self, message, file=None, thumb=None, **kwargs):
+        if thumb is not None:
+            await self.backend.request(FAKE_PREVIEW_SIZE)
+            data = self.backend.read(message.id, 0, FAKE_PREVIEW_SIZE)
+        else:
+            data = bytearray()
+            async for chunk in FakeDownloadIter(self.backend, message.id, 0, 512 * 1024, None):
+                data.extend(chunk)
+            data = bytes(data)
+
+        if file is bytes:
+            return data
+        if hasattr(file, 'write'):
+            file.write(data)
+            return file
+        with open(file, 'wb') as out:
+            out.write(data)
+        return file
@@ -0,0 +1,1944 @@
+import io
+import os
+import tempfile
+import zipfile
+import tarfile
+import shutil
+import sqlite3
+import collections
+import asyncio
+import concurrent.futures
+import threading
+import random
+import time
+import json
+import logging
+import weakref
+from datetime import datetime, timedelta, timezone
+from telethon import TelegramClient, events, functions, types
+from telethon.errors import (
+    FileReferenceExpiredError, FilerefUpgradeNeededError, FloodWaitError,
+    ServerError, TimedOutError, RpcCallFailError
+)
+from telethon.sessions import StringSession
+from metrics import metrics
+
+# Общее ядро получения и скачивания медиа из избранного Telegram.
+# Не зависит от Streamlit и используется веб-приложением (app.py) и экспортом из командной строки (export.py)
+
+log = logging.getLogger(__name__)
+
+# API для Telegram по умолчанию (для локальной разработки)
+DEFAULT_API_ID = 1713092
+DEFAULT_API_HASH = "c96e3d68d80373c29270bb8a2edbb1f5"
+
+# Настройки пула клиентов Telegram
+CLIENT_IDLE_TIMEOUT = 600  # секунд простоя, после которых соединение закрывается
+CLIENT_HEALTH_CHECK_INTERVAL = 60  # секунд между проверками живости соединения
+CLIENT_PING_TIMEOUT = 10  # секунд ожидания ответа на ping
+LOOP_STOP_TIMEOUT = 10  # секунд ожидания при закрытии клиентов и остановке фонового цикла
+CLIENT_CALL_TIMEOUT = 300  # секунд, дольше которых вызывающий поток не ждет операцию с клиентом
+
+# Настройки сборки архивов
+ARCHIVE_CHUNK_SIZE = 512 * 1024  # байт за один запрос к Telegram (кратно 4 КБ, не больше 512 КБ)
+ARCHIVE_DIR = None  # каталог для временных архивов (None - системный каталог)
+ARCHIVE_CONCURRENCY = 4  # сколько файлов скачивается одновременно при сборке архива
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024  # байт файла в памяти, сверх этого - во временный файл на диске
+
+ARCHIVE_DUPLICATES_NAME = "duplicates.txt"  # файл в архиве со списком повторно сохраненных файлов
+ARCHIVE_ENTRY_OVERHEAD = 4096  # байт на заголовки одного файла в томе, с запасом (ZIP64, PAX и выравнивание TAR)
+ARCHIVE_VOLUME_RESERVE = 64 * 1024  # байт на конец тома: оглавление ZIP или завершающие блоки TAR
+ARCHIVE_FORMATS = ('zip', 'tar')  # форматы архивов: ZIP и TAR без сжатия (меньше всего работы процессору)
+
+# Настройки многопоточного скачивания больших файлов
+MULTIPART_THRESHOLD = 20 * 1024 * 1024  # файлы от этого размера качаются частями параллельно
+MULTIPART_PART_SIZE = 4 * 1024 * 1024  # размер части, байт (кратно ARCHIVE_CHUNK_SIZE)
+MULTIPART_CONCURRENCY = 4  # сколько частей одного файла скачивается одновременно
+
+# Настройки повторов при сетевых ошибках и FloodWait
+DOWNLOAD_RETRIES = 5  # сколько раз повторять операцию, прежде чем сдаться
+RETRY_BASE_DELAY = 1  # секунд перед первым повтором, дальше задержка удваивается
+RETRY_MAX_DELAY = 60  # максимальная задержка между повторами, секунд
+PART_MAX_AGE = 24 * 60 * 60  # секунд хранения недокачанных файлов для продолжения загрузки
+ARCHIVE_MAX_AGE = 24 * 60 * 60  # секунд хранения брошенных архивов и их манифестов
+
+# Настройки планировщика запросов к Telegram (общего для всех сессий процесса)
+SCHEDULER_GLOBAL_RATE = 50  # запросов в секунду от всего процесса
+SCHEDULER_GLOBAL_BURST = 100  # сколько запросов процесс может сделать подряд без ожидания
+SCHEDULER_ACCOUNT_RATE = 25  # запросов в секунду от одного аккаунта
+SCHEDULER_ACCOUNT_BURST = 50  # сколько запросов аккаунт может сделать подряд без ожидания
+SCHEDULER_DOWNLOAD_RATE = 64  # запросов частей файлов в секунду от всего процесса (по 512 КБ - около 32 МБ/с)
+SCHEDULER_ACTIVE_WINDOW = 5  # секунд после последней загрузки, пока аккаунт делит полосу с остальными
+SCHEDULER_MAX_FLOOD_WAIT = 300  # FloodWait дольше этого (секунд) не пережидается, а возвращается ошибкой
+SCHEDULER_PRUNE_INTERVAL = 60  # секунд без запросов, после которых состояние аккаунта в планировщике удаляется
+
+# Квоты ресурсов процесса, общего для всех пользователей (задачи сверх квот ждут в очереди)
+QUOTA_SESSION_JOBS = 2  # фоновых задач одной сессии одновременно (скачивание файла, сборка архива)
+QUOTA_TOTAL_JOBS = 8  # фоновых задач всех сессий одновременно
+QUOTA_SESSION_BYTES = 4 * 1024 * 1024 * 1024  # байт, которые одновременно скачивают задачи одной сессии
+QUOTA_TOTAL_BYTES = 16 * 1024 * 1024 * 1024  # байт, которые одновременно скачивают задачи всех сессий
+QUOTA_ARCHIVE_BYTES = 20 * 1024 * 1024 * 1024  # самый большой архив, который можно собрать (None - без ограничения)
+QUOTA_CLIENTS = 100  # открытых соединений с Telegram одновременно
+ADMISSION_POLL_INTERVAL = 0.5  # секунд между проверками очереди
+ADMISSION_LOG_SIZE = 200  # сколько последних решений о допуске хранится для администратора
+
+# Настройки локального индекса избранного
+INDEX_DB_PATH = os.path.join(tempfile.gettempdir(), "telegram_favorites_index.sqlite3")
+INDEX_BATCH_SIZE = 500  # сколько записей сохранять за одну транзакцию при синхронизации
+INDEX_RECONCILE_BATCH = 100  # сколько сообщений индекса проверять одним запросом (больше Telegram не отдает)
+# Версия данных индекса: увеличивается, когда меняется то, как описание медиа получается из сообщения
+# (например, определение типа), или состав таблиц - индекс со старой версией заполняется заново
+INDEX_SCHEMA_VERSION = 3
+FAVORITES_CACHE_TTL = 300  # секунд, в течение которых список избранного берется из памяти
+
+# Фильтры поиска Telegram для типов медиа из get_media_type
+MEDIA_SEARCH_FILTERS = {
+    'photo': types.InputMessagesFilterPhotos,
+    'video': types.InputMessagesFilterVideo,
+    'document': types.InputMessagesFilterDocument,
+    'audio': types.InputMessagesFilterMusic,
+    'voice': types.InputMessagesFilterVoice,
+}
+
+# Настройки кэша медиа на диске
+MEDIA_CACHE_DIR = os.path.join(tempfile.gettempdir(), "telegram_favorites_cache")
+MEDIA_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # бюджет кэша, байт
+
+# Настройки миниатюр
+PREVIEW_MEDIA_TYPES = ('photo', 'video')  # типы файлов, для которых показываются миниатюры
+PREVIEW_THUMB_TYPES = ('m', 's', 'i')  # предпочтительные миниатюры Telegram: 320px, 100px, встроенная
+PREVIEW_CONCURRENCY = 8  # сколько миниатюр скачивается одновременно
+
+
+# Фоновый цикл событий в отдельном потоке: весь ввод-вывод Telegram выполняется в нем,
+# а вызывающий поток (например, скрипт Streamlit) только отправляет задачи и ждет результат
+class BackgroundLoop:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="telegram-io", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Запустить корутину в фоновом цикле, вернуть concurrent.futures.Future
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # Выполнить корутину в фоновом цикле и дождаться результата
+    # Если результата нет за timeout секунд, корутина отменяется и выбрасывается TimeoutError
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    # Остановить цикл
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(LOOP_STOP_TIMEOUT)
+
+
+# Фоновая задача (скачивание файла, сборка архива) с прогрессом, отменой и результатом
+class Job:
+    def __init__(self):
+        self.future = None
+        self.done_count = 0
+        self.total_count = 0
+        self.outputs = []  # готовые части результата, доступные до завершения задачи (например, тома архива)
+        self.started = time.monotonic()
+        self.label = None  # описание задачи для очереди и журнала допуска
+        self.cost = 0  # сколько байт скачает задача (для квот)
+        self.queued = False  # задача ждет в очереди, пока не освободятся квоты
+        self.queue_position = 0  # сколько задач в очереди перед этой
+        self.queue_reason = None  # какая квота держит задачу в очереди
+
+    # Обновить прогресс (вызывается из корутины задачи)
+    def update(self, done_count, total_count):
+        self.done_count = done_count
+        self.total_count = total_count
+
+    # Добавить готовую часть результата (вызывается из корутины задачи)
+    def add_output(self, output):
+        self.outputs.append(output)
+
+    # Доля выполненной работы от 0 до 1
+    def progress(self):
+        if not self.total_count:
+            return 0.0
+        return min(1.0, self.done_count / self.total_count)
+
+    def running(self):
+        return not self.future.done()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
+    def cancel(self):
+        self.future.cancel()
+
+    # Ошибка завершившейся задачи или None
+    def error(self):
+        if self.running() or self.cancelled():
+            return None
+        return self.future.exception()
+
+    # Результат завершившейся задачи (None, если задача не завершилась успешно)
+    def result(self):
+        if self.running() or self.cancelled() or self.future.exception() is not None:
+            return None
+        return self.future.result()
+
+
+# Ведро токенов: не больше rate операций в секунду в среднем и burst подряд
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Через сколько секунд появится токен (0 - есть уже сейчас)
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+# Планировщик запросов к Telegram, общий для всех клиентов процесса (все сессии используют один API_ID).
+# Ограничивает запросы каждого аккаунта и всего процесса ведрами токенов, делит полосу загрузки
+# поровну между аккаунтами, которые сейчас скачивают файлы, и после FloodWait придерживает
+# запросы того же метода этого аккаунта, пока не истечет ожидание.
+# Не использует примитивы asyncio, поэтому работает в любом цикле событий
+class RequestScheduler:
+    def __init__(self, global_rate=SCHEDULER_GLOBAL_RATE, global_burst=SCHEDULER_GLOBAL_BURST,
+                 account_rate=SCHEDULER_ACCOUNT_RATE, account_burst=SCHEDULER_ACCOUNT_BURST,
+                 download_rate=SCHEDULER_DOWNLOAD_RATE):
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.download_rate = download_rate
+        self._global = TokenBucket(global_rate, global_burst)
+        self._downloads = TokenBucket(download_rate, download_rate)
+        self._accounts = {}  # аккаунт -> TokenBucket
+        self._account_downloads = {}  # аккаунт -> TokenBucket доли полосы загрузки
+        self._downloading = {}  # аккаунт -> время последней загрузки
+        self._flood_until = {}  # (аккаунт, метод) -> время окончания FloodWait
+        self._pruned = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Удалить состояние аккаунтов, которые давно ничего не запрашивали, и истекшие FloodWait,
+    # чтобы словари не росли все время жизни процесса (вызывается под блокировкой)
+    def _prune(self, now):
+        if now - self._pruned < SCHEDULER_PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        # За это время ведро аккаунта успевает наполниться, поэтому новое ведро ничем не отличается
+        for account, bucket in list(self._accounts.items()):
+            if now - bucket.updated > SCHEDULER_PRUNE_INTERVAL:
+                del self._accounts[account]
+        for account, last in list(self._downloading.items()):
+            if now - last > SCHEDULER_ACTIVE_WINDOW:
+                del self._downloading[account]
+        for account in list(self._account_downloads):
+            if account not in self._downloading:
+                del self._account_downloads[account]
+        for key, until in list(self._flood_until.items()):
+            if until <= now:
+                del self._flood_until[key]
+
+    # Через сколько секунд аккаунт может сделать запрос (0 - токены взяты, можно отправлять)
+    def _reserve(self, account, method, download):
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            waits = [self._flood_until.get((account, method), 0) - now]
+
+            bucket = self._accounts.get(account)
+            if bucket is None:
+                bucket = self._accounts[account] = TokenBucket(self.account_rate, self.account_burst)
+            buckets = [self._global, bucket]
+
+            if download:
+                # Доля аккаунта в полосе загрузки зависит от того, сколько аккаунтов качают сейчас
+                self._downloading[account] = now
+                for other, last in list(self._downloading.items()):
+                    if now - last > SCHEDULER_ACTIVE_WINDOW:
+                        del self._downloading[other]
+                        self._account_downloads.pop(other, None)
+                share = self.download_rate / len(self._downloading)
+                share_bucket = self._account_downloads.get(account)
+                if share_bucket is None:
+                    share_bucket = self._account_downloads[account] = TokenBucket(share, share)
+                share_bucket.rate = share
+                share_bucket.burst = share
+                buckets += [self._downloads, share_bucket]
+
+            waits += [bucket.wait_time(now) for bucket in buckets]
+            wait = max(waits)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+            return max(0, wait)
+
+    # Дождаться очереди на запрос метода method от аккаунта account
+    async def acquire(self, account, method, download=False):
+        waited = 0
+        while True:
+            wait = self._reserve(account, method, download)
+            if wait == 0:
+                break
+            waited += wait
+            await asyncio.sleep(wait)
+        if waited:
+            metrics.inc('telegram_scheduler_wait_seconds_total', waited)
+
+    # Telegram ответил FloodWait: запросы метода от аккаунта откладываются на seconds секунд
+    def flood_wait(self, account, method, seconds):
+        with self._lock:
+            until = time.monotonic() + seconds
+            key = (account, method)
+            self._flood_until[key] = max(self._flood_until.get(key, 0), until)
+        metrics.inc('telegram_flood_waits_total')
+        metrics.inc('telegram_flood_wait_seconds_total', seconds)
+
+
+# Планировщик процесса
+request_scheduler = RequestScheduler()
+
+
+# Контроль допуска: один процесс обслуживает всех пользователей, поэтому фоновые задачи, объем
+# одновременно скачиваемых ими данных и соединения с Telegram ограничены квотами сессии и процесса.
+# Задача сверх квот не завершается ошибкой, а ждет в очереди; решения пишутся в журнал для администратора.
+# Как и планировщик, не использует примитивы asyncio
+class AdmissionController:
+    def __init__(self, session_jobs=QUOTA_SESSION_JOBS, total_jobs=QUOTA_TOTAL_JOBS,
+                 session_bytes=QUOTA_SESSION_BYTES, total_bytes=QUOTA_TOTAL_BYTES,
+                 archive_bytes=QUOTA_ARCHIVE_BYTES, clients=QUOTA_CLIENTS):
+        self.session_jobs = session_jobs
+        self.total_jobs = total_jobs
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.archive_bytes = archive_bytes
+        self.clients = clients
+        self._queue = []  # ждущие задачи в порядке поступления: (сессия, Job, время постановки)
+        self._running = {}  # Job -> сессия
+        self._connections = set()  # сессии, которым выделено соединение
+        self._waiting_connections = []  # сессии, ждущие соединения, в порядке поступления
+        self._log = collections.deque(maxlen=ADMISSION_LOG_SIZE)
+        self._lock = threading.Lock()
+
+    # Сколько байт задачи учитывается в квотах: задача больше квоты сессии занимает ее целиком
+    def _charge(self, job):
+        return min(job.cost, self.session_bytes)
+
+    # Записать решение в журнал (вызывается под блокировкой)
+    def _record(self, session, task, decision, detail=None):
+        self._log.append({
+            'time': datetime.now().strftime('%H:%M:%S'),
+            'session': session[:8],
+            'task': task,
+            'decision': decision,
+            'detail': detail,
+        })
+        log.info("Допуск: %s %s (%s) %s", session[:8], task, decision, detail or '')
+
+    # Какая квота сессии не дает запустить задачу (None - квот сессии хватает)
+    def _session_limit(self, session, charge):
+        running = [job for job, owner in self._running.items() if owner == session]
+        if len(running) >= self.session_jobs:
+            return "лимит задач сессии"
+        # Единственной задаче хватает квоты всегда, даже если она больше квоты
+        if running and sum(map(self._charge, running)) + charge > self.session_bytes:
+            return "лимит объема загрузок сессии"
+        return None
+
+    # Какая квота процесса не дает запустить задачу (None - квот процесса хватает)
+    def _total_limit(self, charge):
+        if len(self._running) >= self.total_jobs:
+            return "лимит задач сервера"
+        if self._running and sum(map(self._charge, self._running)) + charge > self.total_bytes:
+            return "лимит объема загрузок сервера"
+        return None
+
+    # Запустить ждущие задачи, которым хватает квот (вызывается под блокировкой).
+    # Задача, которую держат только квоты ее сессии, не задерживает другие сессии, а задачу,
+    # которую держат квоты процесса, никто не обгоняет - иначе большие задачи ждали бы бесконечно
+    def _dispatch(self):
+        blocked = None
+        position = 0
+        for entry in list(self._queue):
+            session, job, enqueued = entry
+            charge = self._charge(job)
+            reason = self._session_limit(session, charge)
+            if reason is None:
+                reason = blocked or self._total_limit(charge)
+                blocked = reason
+            if reason is not None:
+                job.queue_position = position
+                job.queue_reason = reason
+                position += 1
+                continue
+
+            self._queue.remove(entry)
+            self._running[job] = session
+            job.queued = False
+            waited = time.monotonic() - enqueued
+            self._record(session, job.label, 'admitted', f"ждала {waited:.0f} с" if waited >= 1 else None)
+            metrics.add('telegram_jobs_queued', -1)
+            metrics.add('telegram_jobs_running', 1)
+            metrics.add('telegram_admitted_bytes', charge)
+
+    # Дождаться допуска задачи job сессии session; пока задача ждет, job.queued=True
+    async def admit(self, session, job):
+        with self._lock:
+            self._queue.append((session, job, time.monotonic()))
+            job.queued = True
+            metrics.add('telegram_jobs_queued', 1)
+            self._dispatch()
+            if job.queued:
+                metrics.inc('telegram_admission_queued_total')
+                self._record(session, job.label, 'queued', job.queue_reason)
+        try:
+            while job.queued:
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+                with self._lock:
+                    self._dispatch()
+        except BaseException:
+            # Задачу отменили в очереди
+            with self._lock:
+                for entry in self._queue:
+                    if entry[1] is job:
+                        self._queue.remove(entry)
+                        metrics.add('telegram_jobs_queued', -1)
+                        self._record(session, job.label, 'cancelled', "отменена в очереди")
+                        break
+            self.release(job)
+            raise
+
+    # Задача завершилась: освободить ее квоты
+    def release(self, job):
+        with self._lock:
+            session = self._running.pop(job, None)
+            if session is None:
+                return
+            metrics.add('telegram_jobs_running', -1)
+            metrics.add('telegram_admitted_bytes', -self._charge(job))
+            self._dispatch()
+
+    # Можно ли собрать архив task размером size байт (отказ записывается в журнал)
+    def allow_archive(self, session, task, size):
+        if self.archive_bytes is None or size <= self.archive_bytes:
+            return True
+        with self._lock:
+            self._record(session, task, 'rejected', f"архив {size} байт больше квоты {self.archive_bytes} байт")
+        metrics.inc('telegram_admission_rejected_total')
+        return False
+
+    # Дождаться соединения для сессии session (если оно уже выделено - сразу)
+    async def connect(self, session):
+        with self._lock:
+            if session in self._connections:
+                return
+            if not self._waiting_connections and len(self._connections) < self.clients:
+                self._connections.add(session)
+                metrics.add('telegram_connections', 1)
+                return
+            self._waiting_connections.append(session)
+            metrics.inc('telegram_admission_queued_total')
+            self._record(session, "соединение", 'queued', "лимит соединений")
+        enqueued = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+                with self._lock:
+                    if session in self._connections:
+                        self._waiting_connections.remove(session)
+                        return
+                    if self._waiting_connections[0] == session and len(self._connections) < self.clients:
+                        self._waiting_connections.pop(0)
+                        self._connections.add(session)
+                        metrics.add('telegram_connections', 1)
+                        self._record(
+                            session, "соединение", 'admitted', f"ждало {time.monotonic() - enqueued:.0f} с"
+                        )
+                        return
+        except BaseException:
+            with self._lock:
+                if session in self._waiting_connections:
+                    self._waiting_connections.remove(session)
+            raise
+
+    # Освободить соединение сессии session
+    def disconnect(self, session):
+        with self._lock:
+            if session in self._connections:
+                self._connections.discard(session)
+                metrics.add('telegram_connections', -1)
+
+    # Состояние квот для страницы администратора
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'limits': {
+                    'session_jobs': self.session_jobs,
+                    'total_jobs': self.total_jobs,
+                    'session_bytes': self.session_bytes,
+                    'total_bytes': self.total_bytes,
+                    'archive_bytes': self.archive_bytes,
+                    'clients': self.clients,
+                },
+                'running_bytes': sum(map(self._charge, self._running)),
+                'connections': len(self._connections),
+                'waiting_connections': len(self._waiting_connections),
+                'running': [
+                    {
+                        'session': session[:8], 'task': job.label, 'bytes': job.cost,
+                        'progress': job.progress(), 'seconds': round(now - job.started),
+                    }
+                    for job, session in self._running.items()
+                ],
+                'queue': [
+                    {
+                        'session': session[:8], 'task': job.label, 'bytes': job.cost,
+                        'reason': job.queue_reason, 'seconds': round(now - enqueued),
+                    }
+                    for session, job, enqueued in self._queue
+                ],
+                'log': list(reversed(self._log)),
+            }
+
+
+# TelegramClient, все запросы которого проходят через планировщик.
+# FloodWait не превращается в ошибку: запрос переносится и повторяется после ожидания
+class ScheduledTelegramClient(TelegramClient):
+    def __init__(self, *args, account=None, scheduler=request_scheduler, **kwargs):
+        # Telethon сам не ждет FloodWait ни перед запросом, ни при повторе - ожиданием управляет планировщик
+        kwargs['flood_sleep_threshold'] = 0
+        super().__init__(*args, **kwargs)
+        self.account = account
+        self.scheduler = scheduler
+
+    # Аккаунт для квот планировщика: id пользователя Telegram, а пока он не известен (до входа) -
+    # account из конструктора. Так несколько сессий одного аккаунта делят одну квоту
+    @property
+    def scheduler_account(self):
+        return self._self_id or self.account
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        requests = request if isinstance(request, (list, tuple)) else [request]
+        method = type(requests[0]).__name__
+        download = isinstance(requests[0], functions.upload.GetFileRequest)
+        while True:
+            account = self.scheduler_account
+            await self.scheduler.acquire(account, method, download)
+            try:
+                return await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except FloodWaitError as e:
+                if e.seconds > SCHEDULER_MAX_FLOOD_WAIT:
+                    raise
+                log.warning("FloodWait %d с для %s, запрос отложен", e.seconds, method)
+                self.scheduler.flood_wait(account, method, e.seconds)
+
+
+# Запись пула: подключенный клиент одной сессии
+class PooledClient:
+    def __init__(self, session_str, api_id, api_hash, account=None):
+        self.client = ScheduledTelegramClient(StringSession(session_str), api_id, api_hash, account=account)
+        self.connect_lock = asyncio.Lock()
+        self.active = 0  # сколько операций сейчас используют клиент
+        self.last_used = time.monotonic()
+        self.last_checked = 0.0
+
+    # Подключиться или проверить соединение, если оно давно не использовалось
+    async def ensure_connected(self):
+        async with self.connect_lock:
+            now = time.monotonic()
+            if not self.client.is_connected():
+                await self.connect()
+            elif now - self.last_checked > CLIENT_HEALTH_CHECK_INTERVAL:
+                try:
+                    await asyncio.wait_for(
+                        self.client(functions.PingRequest(ping_id=random.getrandbits(63))),
+                        CLIENT_PING_TIMEOUT
+                    )
+                except Exception:
+                    # Соединение зависло - переподключаемся
+                    await self.client.disconnect()
+                    await self.connect()
+            self.last_checked = now
+
+    async def connect(self):
+        started = time.monotonic()
+        await self.client.connect()
+        metrics.observe('telegram_connect_seconds', time.monotonic() - started)
+        # Узнаем id пользователя, чтобы планировщик считал квоты по аккаунту, а не по сессии
+        # (для неавторизованной сессии вернется None)
+        await self.client.get_me(input_peer=True)
+
+    # Закрыть соединение
+    async def close(self):
+        try:
+            if self.client.is_connected():
+                await self.client.disconnect()
+        except Exception:
+            pass
+
+
+# Пул клиентов: одно живое соединение на сессию пользователя, все клиенты работают в фоновом цикле
+# Число соединений и фоновые задачи ограничены квотами admission (AdmissionController)
+class ClientPool:
+    def __init__(self, api_id, api_hash, background, admission=None):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.background = background
+        self.admission = admission or AdmissionController()
+        self._entries = {}
+        self._close_listeners = []  # функции listener(key), вызываемые при закрытии клиента сессии key
+        self._lock = threading.Lock()
+
+    # Вызывать listener(key) каждый раз, когда клиент сессии key закрывается (выход или простой)
+    def add_close_listener(self, listener):
+        self._close_listeners.append(listener)
+
+    # Сообщить подписчикам, что клиент сессии key закрыт
+    def _notify_close(self, key):
+        for listener in self._close_listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                log.warning("Ошибка обработчика закрытия клиента: %s", e)
+
+    # Взять из пула клиент сессии key (создав его при необходимости) и отметить его занятым
+    def _acquire(self, key, session_str):
+        self.evict_idle()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = PooledClient(session_str, self.api_id, self.api_hash, account=key)
+                self._entries[key] = entry
+            entry.active += 1
+            entry.last_used = time.monotonic()
+            crowded = self._take_excess()
+        for crowded_key, crowded_entry in crowded:
+            self._close(crowded_key, crowded_entry)
+        return entry
+
+    # Клиент больше не занят операцией. Если другие сессии ждут соединения (клиентов в пуле
+    # больше квоты), освободившийся клиент или более старые незанятые закрываются сразу
+    def _release_entry(self, entry):
+        with self._lock:
+            entry.active -= 1
+            entry.last_used = time.monotonic()
+            crowded = self._take_excess()
+        for crowded_key, crowded_entry in crowded:
+            self._close(crowded_key, crowded_entry)
+
+    # Подключить клиент записи entry сессии key
+    async def _connect(self, key, entry):
+        # Сверх квоты соединений новая сессия ждет, пока какое-нибудь освободится
+        await self.admission.connect(key)
+        await entry.ensure_connected()
+
+    # Корутина, выполняющая func(client) с клиентом сессии key
+    def _call(self, key, session_str, func):
+        entry = self._acquire(key, session_str)
+
+        async def call():
+            try:
+                await self._connect(key, entry)
+                return await func(entry.client)
+            finally:
+                self._release_entry(entry)
+
+        return call()
+
+    # Выполнить async-функцию func(client) с клиентом сессии key и дождаться результата
+    def run(self, key, session_str, func, timeout=CLIENT_CALL_TIMEOUT):
+        return self.background.run(self._call(key, session_str, func), timeout)
+
+    # Запустить async-функцию func(client, job) как фоновую задачу, не дожидаясь результата
+    # cost - сколько байт скачает задача, label - ее описание; сверх квот задача ждет в очереди
+    def submit(self, key, session_str, func, cost=0, label=None):
+        job = Job()
+        job.cost = cost
+        job.label = label
+
+        async def run():
+            await self.admission.admit(key, job)
+            try:
+                return await self._call(key, session_str, lambda client: func(client, job))
+            finally:
+                self.admission.release(job)
+
+        job.future = self.background.submit(run())
+        return job
+
+    # Перебрать в вызывающем потоке значения async-генератора func(client) с клиентом сессии key
+    # Клиент считается занятым, пока перебор не закончен или генератор не закрыт
+    def iterate(self, key, session_str, func):
+        entry = self._acquire(key, session_str)
+        try:
+            self.background.run(self._connect(key, entry), CLIENT_CALL_TIMEOUT)
+            stream = func(entry.client)
+            try:
+                while True:
+                    try:
+                        yield self.background.run(stream.__anext__(), CLIENT_CALL_TIMEOUT)
+                    except StopAsyncIteration:
+                        return
+            finally:
+                self.background.run(stream.aclose(), LOOP_STOP_TIMEOUT)
+        finally:
+            self._release_entry(entry)
+
+    # Строка StringSession клиента сессии key (после авторизации)
+    def session_string(self, key):
+        with self._lock:
+            entry = self._entries[key]
+        return entry.client.session.save()
+
+    # Закрыть клиент сессии (при выходе пользователя)
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        # Подписчики узнают о выходе, даже если простаивавший клиент уже был закрыт
+        self._notify_close(key)
+        if entry is not None:
+            self.admission.disconnect(key)
+            self.background.run(entry.close(), LOOP_STOP_TIMEOUT)
+
+    # Закрыть клиенты, простаивающие дольше CLIENT_IDLE_TIMEOUT
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                (key, entry) for key, entry in self._entries.items()
+                # Пропускаем клиента, если он сейчас занят
+                if entry.active == 0 and now - entry.last_used > CLIENT_IDLE_TIMEOUT
+            ]
+            for key, _ in idle:
+                del self._entries[key]
+        for key, entry in idle:
+            self._close(key, entry)
+
+    # Убрать из пула незанятые клиенты сверх квоты соединений, начиная с давно не использованных
+    # (вызывается под блокировкой, закрывать клиенты нужно уже без нее)
+    def _take_excess(self):
+        excess = len(self._entries) - self.admission.clients
+        if excess <= 0:
+            return []
+        idle = sorted(
+            (entry.last_used, key) for key, entry in self._entries.items() if entry.active == 0
+        )
+        return [(key, self._entries.pop(key)) for _, key in idle[:excess]]
+
+    # Закрыть клиент, убранный из пула, и освободить его соединение
+    def _close(self, key, entry):
+        self.admission.disconnect(key)
+        self._notify_close(key)
+        self.background.submit(entry.close())
+
+    # Закрыть все клиенты
+    def close_all(self):
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            try:
+                self.release(key)
+            except Exception:
+                pass
+
+
+# Кэш медиа на диске: файлы адресуются по идентификатору медиа в Telegram,
+# при превышении бюджета удаляются давно не использованные
+class MediaCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # ключ -> размер, от старых к новым
+        self._total = 0
+        self._downloading = set()  # ключи, которые сейчас докачиваются в .part файлы
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Восстанавливаем порядок использования по времени изменения файлов
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            if name.endswith('.part'):
+                # Недокачанный файл от прошлого запуска можно докачать, если он не слишком старый
+                if time.time() - stat.st_mtime > PART_MAX_AGE:
+                    os.remove(path)
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total += size
+        self._evict()
+
+    # Путь к файлу в кэше или None, если его нет
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = os.path.join(self.directory, key)
+        try:
+            # Время изменения хранит порядок использования между перезапусками
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+            return None
+        return path
+
+    # Временный файл в каталоге кэша для записи нового медиа
+    def new_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix='.part', delete=False)
+
+    # Занять недокачанный файл ключа key для записи (None, если его уже качает другая задача)
+    def claim_part(self, key):
+        with self._lock:
+            if key in self._downloading:
+                return None
+            self._downloading.add(key)
+        return self.part_path(key)
+
+    # Освободить недокачанный файл ключа key
+    def release_part(self, key):
+        with self._lock:
+            self._downloading.discard(key)
+
+    # Путь недокачанного файла: сохраняется между попытками, чтобы продолжить загрузку
+    def part_path(self, key):
+        return os.path.join(self.directory, key + '.part')
+
+    # Поместить записанный временный файл в кэш под ключом key
+    def add(self, key, temp_path):
+        path = os.path.join(self.directory, key)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._total += size
+            self._evict(keep=key)
+        return path
+
+    # Удалить файлы ключей keys вместе с их вариантами (<ключ>_<размер>) и недокачанными файлами
+    def remove(self, keys):
+        keys = set(keys)
+
+        def matches(name):
+            key = name[:-len('.part')] if name.endswith('.part') else name
+            return key in keys or key.rsplit('_', 1)[0] in keys
+
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                self._total -= self._entries.pop(key)
+        for name in os.listdir(self.directory):
+            if matches(name):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    # Удалять самые старые файлы, пока кэш не уложится в бюджет
+    def _evict(self, keep=None):
+        while self._total > self.max_bytes and self._entries:
+            key, size = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+
+
+# Определить тип медиа
+def get_media_type(message):
+    # Музыка и голосовые - тоже документы, поэтому проверяются раньше
+    if message.photo:
+        return 'photo'
+    elif message.video:
+        return 'video'
+    elif message.voice:
+        return 'voice'
+    elif message.audio:
+        return 'audio'
+    elif message.document:
+        return 'document'
+    else:
+        return 'unknown'
+
+# Получить имя файла
+def get_filename(message):
+    if message.photo:
+        return f"photo_{message.id}.jpg"
+    elif message.video:
+        return getattr(message.video.attributes[0], 'file_name', f"video_{message.id}.mp4") if hasattr(message.video, 'attributes') and message.video.attributes else f"video_{message.id}.mp4"
+    elif message.document:
+        return getattr(message.document.attributes[0], 'file_name', f"document_{message.id}") if hasattr(message.document, 'attributes') and message.document.attributes else f"document_{message.id}"
+    elif message.audio:
+        return getattr(message.audio.attributes[0], 'file_name', f"audio_{message.id}.mp3") if hasattr(message.audio, 'attributes') and message.audio.attributes else f"audio_{message.id}.mp3"
+    elif message.voice:
+        return f"voice_{message.id}.ogg"
+    else:
+        return f"file_{message.id}"
+
+# Описание медиа сообщения для индекса и списка на странице
+def get_media_info(message):
+    file = message.file
+    source = message.photo or message.document
+    return {
+        'id': message.id,
+        'date': message.date.strftime('%Y-%m-%d %H:%M:%S'),
+        'type': get_media_type(message),
+        'filename': get_filename(message),
+        'size': file.size if file else None,
+        'mime_type': file.mime_type if file else None,
+        'media_id': source.id if source else None,
+    }
+
+# Ключ медиа по описанию из индекса: одинаковый у всех сообщений с одним и тем же фото или документом
+def get_media_key(item):
+    if item['media_id'] is None:
+        return None
+    kind = 'photo' if item['type'] == 'photo' else 'document'
+    return f"{kind}_{item['media_id']}"
+
+# Удалить из кэша файлы и миниатюры медиа из items (при выходе пользователя)
+def remove_cached_media(cache, items):
+    keys = []
+    for item in items:
+        if get_media_key(item) is not None:
+            keys += [get_media_key(item), preview_cache_key(item)]
+    cache.remove(keys)
+
+# Открыть локальный индекс медиа из избранного (SQLite)
+def open_media_index():
+    conn = sqlite3.connect(INDEX_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            user_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            type TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER,
+            mime_type TEXT,
+            media_id INTEGER,
+            PRIMARY KEY (user_id, id)
+        )
+    """)
+    # Синхронизация дозагружает только новые сообщения, поэтому уже записанные описания
+    # старой версии иначе так и остались бы прежними
+    if conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_SCHEMA_VERSION:
+        conn.execute("DELETE FROM media")
+        conn.execute("DROP TABLE IF EXISTS sync_state")
+        conn.execute(f"PRAGMA user_version = {INDEX_SCHEMA_VERSION}")
+        conn.commit()
+    # max_id - последнее просмотренное сообщение, включая сообщения без медиа: до него индекс полон.
+    # Незавершенный проход: top_id - самое новое его сообщение, offset_id - самое старое из уже записанных
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            user_id INTEGER PRIMARY KEY,
+            max_id INTEGER NOT NULL,
+            top_id INTEGER,
+            offset_id INTEGER
+        )
+    """)
+    return conn
+
+# Дозагрузить в индекс сообщения новее последнего просмотренного
+# Прерванный проход (например, первый по длинной истории) продолжается с самого старого записанного сообщения
+# on_progress(просмотрено сообщений) вызывается после каждой сохраненной пачки
+async def sync_media_index(client, user_id, on_progress=None):
+    conn = open_media_index()
+    try:
+        row = conn.execute(
+            "SELECT max_id, top_id, offset_id FROM sync_state WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        min_id = row['max_id'] if row else 0
+        top_id = row['top_id'] if row and row['offset_id'] else None
+        offset_id = row['offset_id'] if row and row['offset_id'] else 0
+
+        # Позиция прохода сохраняется вместе с записанными описаниями, чтобы не потерять пропуски
+        def save_batch(batch, offset_id):
+            save_media_index(conn, user_id, batch)
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state (user_id, max_id, top_id, offset_id) VALUES (?, ?, ?, ?)",
+                (user_id, min_id, top_id, offset_id)
+            )
+            conn.commit()
+
+        batch = []
+        seen = 0
+        # iter_messages сам постранично обходит историю от новых к старым (по 100 сообщений за запрос).
+        # Паузу между запросами (wait_time) не делаем: запросы и так распределяет RequestScheduler
+        async for message in client.iter_messages('me', min_id=min_id, offset_id=offset_id, wait_time=0):
+            if top_id is None:
+                top_id = message.id
+            if message.media:
+                batch.append(get_media_info(message))
+            seen += 1
+            if seen % INDEX_BATCH_SIZE == 0:
+                save_batch(batch, message.id)
+                batch = []
+                if on_progress is not None:
+                    on_progress(seen)
+        save_media_index(conn, user_id, batch)
+
+        # Проход завершен: индекс полон до самого нового его сообщения
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (user_id, max_id, top_id, offset_id) VALUES (?, ?, NULL, NULL)",
+            (user_id, top_id if top_id is not None else min_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+# Записать описания медиа в индекс
+def save_media_index(conn, user_id, items):
+    conn.executemany(
+        """INSERT OR REPLACE INTO media
+           (user_id, id, date, type, filename, size, mime_type, media_id)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (user_id, item['id'], item['date'], item['type'], item['filename'],
+             item['size'], item['mime_type'], item['media_id'])
+            for item in items
+        ]
+    )
+
+# Прочитать индекс пользователя, новые сообщения первыми
+def load_media_index(user_id):
+    conn = open_media_index()
+    try:
+        rows = conn.execute(
+            """SELECT id, date, type, filename, size, mime_type, media_id
+               FROM media WHERE user_id = ? ORDER BY id DESC""",
+            (user_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+# Удалить из индекса сообщения с номерами ids
+def remove_from_media_index(user_id, ids):
+    conn = open_media_index()
+    try:
+        conn.executemany(
+            "DELETE FROM media WHERE user_id = ? AND id = ?",
+            [(user_id, message_id) for message_id in ids]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+# Убрать из индекса сообщения, которые больше не существуют или остались без медиа
+# События об удалении приходят, только пока клиент подключен, поэтому индекс периодически сверяется с Telegram
+async def reconcile_media_index(client, user_id):
+    conn = open_media_index()
+    try:
+        rows = conn.execute("SELECT id FROM media WHERE user_id = ? ORDER BY id DESC", (user_id,)).fetchall()
+        ids = [row['id'] for row in rows]
+    finally:
+        conn.close()
+
+    removed = []
+    for start in range(0, len(ids), INDEX_RECONCILE_BATCH):
+        batch = ids[start:start + INDEX_RECONCILE_BATCH]
+        messages = await call_with_retries(lambda: client.get_messages('me', ids=batch))
+        removed += [
+            message_id for message_id, message in zip(batch, messages) if message is None or not message.media
+        ]
+    if removed:
+        remove_from_media_index(user_id, removed)
+    return removed
+
+# Удалить индекс пользователя (при выходе данные не остаются на сервере)
+def clear_media_index(user_id):
+    conn = open_media_index()
+    try:
+        conn.execute("DELETE FROM media WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM sync_state WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+# Получить список медиа из избранного через локальный индекс
+# on_progress(просмотрено сообщений) - прогресс синхронизации (см. sync_media_index)
+async def fetch_favorites(client, user_id, on_progress=None):
+    # Вместо GetSavedDialogsRequest используем альтернативный подход
+    # Сообщения из "Сохраненные сообщения" (Saved Messages) - диалог с самим собой
+    # Докачиваем только сообщения новее уже проиндексированных, а уже проиндексированные
+    # сверяем с Telegram: удаленные без подключенного клиента сообщения иначе остались бы в списке
+    started = time.monotonic()
+    await reconcile_media_index(client, user_id)
+    await sync_media_index(client, user_id, on_progress)
+    items = load_media_index(user_id)
+    metrics.observe('telegram_listing_seconds', time.monotonic() - started)
+    return items
+
+# Подходит ли описание медиа под фильтры
+# filters - словарь с необязательными ключами: types (список типов), date_from и date_to (datetime.date, включительно),
+# min_size и max_size (байт); отсутствующий или пустой ключ не ограничивает
+def matches_media_filters(item, filters):
+    if filters.get('types') and item['type'] not in filters['types']:
+        return False
+    # Дата в индексе хранится как '%Y-%m-%d %H:%M:%S' (UTC)
+    day = item['date'][:10]
+    if filters.get('date_from') and day < filters['date_from'].isoformat():
+        return False
+    if filters.get('date_to') and day > filters['date_to'].isoformat():
+        return False
+    size = item['size']
+    if filters.get('min_size') is not None and (size is None or size < filters['min_size']):
+        return False
+    if filters.get('max_size') is not None and (size is None or size > filters['max_size']):
+        return False
+    return True
+
+# Отобрать из списка медиа подходящие под фильтры
+def filter_media(items, filters):
+    return [item for item in items if matches_media_filters(item, filters)]
+
+# Сообщения с медиа из избранного, подходящие под фильтры, без полного обхода истории:
+# тип отбирается фильтрами поиска Telegram, период - через offset_date и остановку на первом более старом сообщении
+async def iter_favorite_messages(client, filters=None):
+    filters = filters or {}
+    offset_date = None
+    if filters.get('date_to'):
+        day_after = filters['date_to'] + timedelta(days=1)
+        offset_date = datetime(day_after.year, day_after.month, day_after.day, tzinfo=timezone.utc)
+
+    seen = set()
+    # Без типов - один обход всех сообщений
+    for media_type in filters.get('types') or [None]:
+        search_filter = MEDIA_SEARCH_FILTERS[media_type]() if media_type else None
+        async for message in client.iter_messages('me', filter=search_filter, offset_date=offset_date):
+            if filters.get('date_from') and message.date.date() < filters['date_from']:
+                break
+            # Фильтры Telegram шире наших типов (например, документы включают видео) - проверяем еще раз
+            if not message.media or message.id in seen:
+                continue
+            if not matches_media_filters(get_media_info(message), filters):
+                continue
+            seen.add(message.id)
+            yield message
+
+# Список избранного в памяти процесса по id пользователя, чтобы перезапуски страницы не ходили в Telegram
+# Список обновляется по событиям Telegram о новых и удаленных сообщениях, пока клиент подключен.
+# Через ttl секунд список устаревает: индекс дозагружается и сверяется с Telegram (см. fetch_favorites),
+# поэтому изменения, случившиеся без подключенного клиента, тоже попадают в список
+class FavoritesCache:
+    def __init__(self, ttl=FAVORITES_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (время загрузки, список новых первыми)
+        self._watched = weakref.WeakSet()  # клиенты, на которых уже подписаны обработчики
+        self._lock = threading.Lock()
+
+    # Список пользователя или None, если его нет или он устарел
+    def get(self, user_id):
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            return list(entry[1])
+
+    def put(self, user_id, items):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._entries[user_id] = (now, list(items))
+
+    # Удалить устаревшие списки: пользователи, закрывшие вкладку без выхода, не держат их в памяти
+    # (вызывается под блокировкой)
+    def _expire(self, now):
+        for user_id in [user_id for user_id, entry in self._entries.items() if now - entry[0] > self.ttl]:
+            del self._entries[user_id]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    # Добавить новое сообщение в закэшированный список
+    def add(self, user_id, item):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            items = [existing for existing in entry[1] if existing['id'] != item['id']]
+            items.append(item)
+            items.sort(key=lambda existing: existing['id'], reverse=True)
+            self._entries[user_id] = (entry[0], items)
+
+    # Убрать удаленные сообщения из закэшированного списка
+    def remove(self, user_id, ids):
+        ids = set(ids)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            items = [item for item in entry[1] if item['id'] not in ids]
+            self._entries[user_id] = (entry[0], items)
+
+    # Подписать клиент пользователя user_id на изменения в избранном (один раз на клиент)
+    def watch(self, client, user_id):
+        with self._lock:
+            if client in self._watched:
+                return
+            self._watched.add(client)
+
+        async def on_new_message(event):
+            # Избранное - это личный чат пользователя с самим собой
+            if event.chat_id != user_id or not event.message.media:
+                return
+            item = get_media_info(event.message)
+            conn = open_media_index()
+            try:
+                save_media_index(conn, user_id, [item])
+                conn.commit()
+            finally:
+                conn.close()
+            self.add(user_id, item)
+
+        async def on_message_deleted(event):
+            # Для личных чатов Telegram не сообщает, из какого чата удалены сообщения,
+            # но номера сообщений в личных чатах уникальны в пределах аккаунта
+            if event.chat_id not in (None, user_id):
+                return
+            remove_from_media_index(user_id, event.deleted_ids)
+            self.remove(user_id, event.deleted_ids)
+
+        client.add_event_handler(on_new_message, events.NewMessage())
+        client.add_event_handler(on_message_deleted, events.MessageDeleted())
+
+# Потоково записать медиа сообщения в файловый объект out блоками по chunk_size байт
+# Если задан offset (кратный ARCHIVE_CHUNK_SIZE), скачивание начинается с этого байта
+# on_progress(скачано байт, размер файла) вызывается после каждого записанного блока
+async def write_media(client, message, out, chunk_size=ARCHIVE_CHUNK_SIZE,
+                      part_concurrency=MULTIPART_CONCURRENCY, offset=0, on_progress=None):
+    source = message.photo or message.document
+    if source is None:
+        # Прочие типы медиа (контакты и т.п.) небольшие - отдаем их Telethon целиком
+        await client.download_media(message, out)
+        return
+
+    size = message.file.size if message.file else None
+    if size is not None and size - offset >= MULTIPART_THRESHOLD:
+        # Большие файлы качаем несколькими частями одновременно
+        await download_parallel(client, message, out, concurrency=part_concurrency, offset=offset,
+                                on_progress=on_progress)
+        return
+
+    done = offset
+    async for chunk in client.iter_download(source, offset=offset, request_size=chunk_size):
+        out.write(chunk)
+        done += len(chunk)
+        if on_progress is not None:
+            on_progress(done, size)
+
+# Скачать медиа сообщения частями по part_size байт, не более concurrency частей одновременно,
+# и записать их в out строго по порядку (out может быть и потоком без seek)
+async def download_parallel(client, message, out, part_size=MULTIPART_PART_SIZE,
+                            concurrency=MULTIPART_CONCURRENCY, offset=0, on_progress=None):
+    size = message.file.size
+    part_count = (size - offset + part_size - 1) // part_size
+    start = offset
+    # Фото или документ хранят свой DC, Telethon сам подключается к нему для скачивания
+    source = message.photo or message.document
+
+    async def fetch_part(index):
+        nonlocal source
+        offset = start + index * part_size
+        length = min(part_size, size - offset)
+        data = bytearray()
+        while len(data) < length:
+            remaining = length - len(data)
+            stream = client.iter_download(
+                source,
+                offset=offset + len(data),
+                request_size=ARCHIVE_CHUNK_SIZE,
+                limit=(remaining + ARCHIVE_CHUNK_SIZE - 1) // ARCHIVE_CHUNK_SIZE,
+                file_size=size
+            )
+            try:
+                async for chunk in stream:
+                    data.extend(chunk)
+                break
+            except (FileReferenceExpiredError, FilerefUpgradeNeededError):
+                # Ссылка на файл устарела во время скачивания - получаем сообщение заново
+                # и продолжаем с того же места
+                fresh = await client.get_messages('me', ids=message.id)
+                if not fresh or not (fresh.photo or fresh.document):
+                    raise
+                source = fresh.photo or fresh.document
+            finally:
+                await stream.close()
+        return bytes(data[:length])
+
+    # Размер буфера части в памяти (последняя часть может быть короче)
+    def part_length(index):
+        return min(part_size, size - start - index * part_size)
+
+    # Скользящее окно задач: в памяти не больше concurrency частей
+    pending = collections.deque()
+    next_index = 0
+    done = offset
+    try:
+        while next_index < part_count or pending:
+            while next_index < part_count and len(pending) < concurrency:
+                metrics.add('telegram_download_buffer_bytes', part_length(next_index))
+                pending.append((next_index, asyncio.ensure_future(fetch_part(next_index))))
+                next_index += 1
+            index, task = pending.popleft()
+            try:
+                data = await task
+                out.write(data)
+                done += len(data)
+                if on_progress is not None:
+                    on_progress(done, size)
+            finally:
+                metrics.add('telegram_download_buffer_bytes', -part_length(index))
+    finally:
+        for index, task in pending:
+            task.cancel()
+            metrics.add('telegram_download_buffer_bytes', -part_length(index))
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+
+# Через сколько секунд повторить операцию после ошибки error (None - не повторять)
+def get_retry_delay(error, attempt):
+    if attempt >= DOWNLOAD_RETRIES:
+        return None
+    if isinstance(error, FloodWaitError):
+        # Telegram сам сообщает, сколько нужно подождать; слишком долгое ожидание возвращается ошибкой
+        if error.seconds > SCHEDULER_MAX_FLOOD_WAIT:
+            return None
+        return error.seconds + 1
+    if isinstance(error, (ConnectionError, asyncio.TimeoutError, TimedOutError, ServerError, RpcCallFailError)):
+        return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return None
+
+# Выполнить async-функцию func() с повторами при сетевых ошибках и FloodWait
+async def call_with_retries(func):
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            delay = get_retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            log.warning("Повтор %d через %d с после ошибки: %s", attempt, delay, e)
+            metrics.inc('telegram_retries_total')
+            if isinstance(e, FloodWaitError):
+                # Короткие FloodWait пережидает планировщик, сюда доходят только длинные
+                metrics.inc('telegram_flood_waits_total')
+                metrics.inc('telegram_flood_wait_seconds_total', delay)
+            await asyncio.sleep(delay)
+
+# Скачать медиа в файл out с повторами; уже записанные в out целые блоки не скачиваются заново
+async def write_media_resumable(client, message, out, part_concurrency=MULTIPART_CONCURRENCY, on_progress=None):
+    async def download():
+        nonlocal message
+        # Продолжаем с последнего целого блока
+        offset = out.seek(0, os.SEEK_END) // ARCHIVE_CHUNK_SIZE * ARCHIVE_CHUNK_SIZE
+        if not (message.photo or message.document):
+            offset = 0
+        out.seek(offset)
+        out.truncate()
+        try:
+            await write_media(client, message, out, part_concurrency=part_concurrency, offset=offset,
+                              on_progress=on_progress)
+        except (FileReferenceExpiredError, FilerefUpgradeNeededError):
+            # Ссылка на файл устарела между попытками - получаем сообщение заново и повторяем
+            fresh = await client.get_messages('me', ids=message.id)
+            if not fresh or not fresh.media:
+                raise
+            message = fresh
+            await download()
+
+    started = time.monotonic()
+    start_size = out.seek(0, os.SEEK_END)
+    await call_with_retries(download)
+    elapsed = time.monotonic() - started
+    # Докачанные при продолжении байты считаются, уже лежавшие в файле - нет
+    downloaded = max(0, out.tell() - start_size)
+    metrics.observe('telegram_file_download_bytes', downloaded)
+    metrics.observe('telegram_file_download_seconds', elapsed)
+    if elapsed > 0:
+        metrics.observe('telegram_download_throughput_bytes_per_second', downloaded / elapsed)
+    log.info("Сообщение %s: скачано %d байт за %.2f с", message.id, downloaded, elapsed)
+
+# Ключ медиа в кэше: идентификатор фото или документа и вариант размера
+def media_cache_key(message):
+    if message.photo and message.photo.sizes:
+        return f"photo_{message.photo.id}_{message.photo.sizes[-1].type}"
+    if message.document:
+        return f"document_{message.document.id}"
+    return None
+
+# Открыть медиа сообщения для чтения: из кэша или скачав его в кэш
+# Без кэша (cache=None) или если файл в кэш не помещается, файл скачивается в part_path, а без него -
+# во временный файл. Недокачанный part_path остается на диске, следующий вызов продолжит с того же места
+# on_progress(скачано байт, размер файла) - прогресс скачивания (для файла из кэша не вызывается)
+async def open_media(client, message, cache=None, part_path=None, on_progress=None):
+    key = media_cache_key(message) if cache is not None else None
+
+    if key is not None:
+        path = cache.get(key)
+        if path is not None:
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                # Файл успели вытеснить из кэша - скачиваем заново
+                pass
+
+    size = message.file.size if message.file else None
+    cache_part = None
+    if key is not None and size is not None and size <= cache.max_bytes:
+        cache_part = cache.claim_part(key)
+
+    if cache_part is None and part_path is not None:
+        # Файл не помещается в кэш или его уже качает другая задача - качаем в постоянный файл вызывающего
+        with open(part_path, 'ab') as part_file:
+            await write_media_resumable(client, message, part_file, on_progress=on_progress)
+        return open(part_path, 'rb')
+
+    if cache_part is None:
+        # Скачиваем во временный файл
+        spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE, dir=ARCHIVE_DIR)
+        try:
+            await write_media_resumable(client, message, spool, on_progress=on_progress)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    try:
+        # Недокачанный файл остается на диске, следующая попытка продолжит с того же места
+        with open(cache_part, 'ab') as part_file:
+            await write_media_resumable(client, message, part_file, on_progress=on_progress)
+        path = cache.add(key, cache_part)
+    finally:
+        cache.release_part(key)
+    # Открытый файл остается читаемым, даже если его сразу вытеснят из кэша
+    return open(path, 'rb')
+
+# Потоково выдать байты медиа сообщения с start по end включительно (для запросов HTTP Range)
+# Файл из кэша читается с диска, иначе из Telegram скачиваются только блоки, покрывающие диапазон
+async def iter_media_range(client, message, start, end, cache=None):
+    remaining = end - start + 1
+    key = media_cache_key(message) if cache is not None else None
+    path = cache.get(key) if key is not None else None
+    if path is not None:
+        try:
+            media_file = open(path, 'rb')
+        except FileNotFoundError:
+            # Файл успели вытеснить из кэша - берем диапазон из Telegram
+            path = None
+    if path is not None:
+        with media_file:
+            media_file.seek(start)
+            while remaining > 0:
+                chunk = media_file.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        return
+
+    # Telegram отдает файл блоками, смещение которых кратно размеру блока
+    offset = start // ARCHIVE_CHUNK_SIZE * ARCHIVE_CHUNK_SIZE
+    skip = start - offset
+    stream = client.iter_download(
+        message.photo or message.document,
+        offset=offset,
+        request_size=ARCHIVE_CHUNK_SIZE,
+        limit=(skip + remaining + ARCHIVE_CHUNK_SIZE - 1) // ARCHIVE_CHUNK_SIZE,
+        file_size=message.file.size
+    )
+    try:
+        async for chunk in stream:
+            chunk = chunk[skip:skip + remaining]
+            skip = 0
+            remaining -= len(chunk)
+            yield chunk
+            if remaining <= 0:
+                break
+    finally:
+        await stream.close()
+
+# Сохранить медиа сообщения message_id в файл path (False, если медиа нет)
+# Файл, который не попадает в кэш, докачивается в path + '.part': повторный вызов продолжит с того же места
+# on_progress(скачано байт, размер файла) - прогресс скачивания из Telegram
+async def save_media(client, message_id, path, cache=None, on_progress=None):
+    message = await call_with_retries(lambda: client.get_messages('me', ids=message_id))
+    if not message or not message.media:
+        return False
+
+    part_path = path + '.part'
+    with await open_media(client, message, cache, part_path, on_progress) as media_file:
+        # Файл появляется под итоговым именем только целиком. Скачанный в part_path файл просто
+        # переименовывается, а файл из кэша копируется: кэш может вытеснить его в любой момент
+        if getattr(media_file, 'name', None) != part_path:
+            with open(part_path, 'wb') as out:
+                shutil.copyfileobj(media_file, out, ARCHIVE_CHUNK_SIZE)
+    os.replace(part_path, path)
+    return True
+
+# Скачивать медиа сообщений параллельно (не более concurrency одновременно)
+# и выдавать пары (сообщение, открытый файл) строго в исходном порядке
+# get_part_path(message) - постоянный файл для медиа, которое не попадает в кэш (см. open_media)
+async def iter_downloads_in_order(client, messages, cache=None, concurrency=ARCHIVE_CONCURRENCY,
+                                  get_part_path=None):
+    # Слот освобождается только после того, как файл забрали, поэтому
+    # на диске и в памяти одновременно не больше concurrency файлов
+    slots = asyncio.Semaphore(concurrency)
+
+    async def fetch(message):
+        await slots.acquire()
+        try:
+            part_path = get_part_path(message) if get_part_path is not None else None
+            return await open_media(client, message, cache, part_path)
+        except BaseException:
+            slots.release()
+            raise
+
+    tasks = [asyncio.ensure_future(fetch(message)) for message in messages]
+    try:
+        for message, task in zip(messages, tasks):
+            spool = await task
+            try:
+                yield message, spool
+            finally:
+                spool.close()
+                slots.release()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Дожидаемся отмены, чтобы закрыть уже скачанные временные файлы
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                result.close()
+
+# Путь манифеста архива: какие файлы уже в архиве
+def get_manifest_path(archive_path):
+    return archive_path + '.manifest.json'
+
+# Постоянный файл, в который докачивается медиа сообщения message_id, не попадающее в кэш, при сборке архива
+# Сколько байт уже скачано, видно по его размеру, поэтому отдельно в манифесте это не хранится
+def get_archive_part_path(archive_path, message_id):
+    return f"{archive_path}.{message_id}.part"
+
+# Прочитать манифест архива (пустой, если архив собирается заново)
+def load_manifest(archive_path):
+    try:
+        with open(get_manifest_path(archive_path)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {'completed': []}
+    return manifest
+
+# Атомарно сохранить манифест архива
+def save_manifest(archive_path, manifest):
+    manifest_path = get_manifest_path(archive_path)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Удалить архив вместе с манифестом и недокачанными файлами
+def remove_archive(archive_path):
+    directory, name = os.path.split(archive_path)
+    part_paths = [
+        os.path.join(directory, part_name) for part_name in os.listdir(directory or '.')
+        if part_name.startswith(name + '.') and part_name.endswith('.part')
+    ]
+    for path in [archive_path, get_manifest_path(archive_path)] + part_paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# Удалить брошенные архивы с префиксом prefix старше ARCHIVE_MAX_AGE
+def remove_stale_archives(directory, prefix):
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.startswith(prefix) or not os.path.isfile(path):
+            continue
+        if now - os.path.getmtime(path) > ARCHIVE_MAX_AGE:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# Уникальные имена файлов в архиве: id сообщения -> имя
+# Совпадающие имена (без учета регистра) получают суффикс с id сообщения, первое по порядку остается как есть
+# reserved - имена служебных файлов архива (списков копий), которые файлам не достаются
+def get_archive_names(items, reserved=(ARCHIVE_DUPLICATES_NAME,)):
+    names = {}
+    # Имя списка копий занято, даже если копий нет
+    used = {name.lower() for name in reserved}
+    for item in items:
+        # Имя из атрибутов документа может содержать разделители каталогов
+        name = item['filename'].replace('/', '_').replace('\\', '_')
+        if name.lower() in used:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}_{item['id']}{ext}"
+            counter = 1
+            while name.lower() in used:
+                name = f"{stem}_{item['id']}_{counter}{ext}"
+                counter += 1
+        used.add(name.lower())
+        names[item['id']] = name
+    return names
+
+# Найти повторно сохраненные файлы: id копии -> id первого сообщения с тем же медиа
+def find_duplicates(items):
+    originals = {}
+    duplicates = {}
+    for item in items:
+        key = get_media_key(item)
+        if key is None:
+            continue
+        if key in originals:
+            duplicates[item['id']] = originals[key]
+        else:
+            originals[key] = item['id']
+    return duplicates
+
+# Примерный размер архива по индексу: файлы без повторов, без учета сжатия
+def estimate_archive_size(items):
+    duplicates = find_duplicates(items)
+    return sum(item['size'] or 0 for item in items if item['id'] not in duplicates)
+
+# Запись файлов в ZIP-архив; прерванный архив дописывается в режиме 'a'
+class ZipArchiveWriter:
+    def __init__(self, archive_path, manifest):
+        mode = 'w'
+        if manifest['completed'] and os.path.exists(archive_path):
+            try:
+                # Прерванная сборка закрыла архив корректно - дописываем в него
+                zipfile.ZipFile(archive_path).close()
+                mode = 'a'
+            except zipfile.BadZipFile:
+                pass
+        self.resumed = mode == 'a'
+        self.archive = zipfile.ZipFile(archive_path, mode)
+
+    def add(self, name, source, size, mtime):
+        # Дата файла в ZIP хранится в местном времени, как ее записывает и сам zipfile
+        info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+        with self.archive.open(info, 'w', force_zip64=True) as entry:
+            shutil.copyfileobj(source, entry, ARCHIVE_CHUNK_SIZE)
+
+    def add_bytes(self, name, data):
+        if name not in self.archive.namelist():
+            self.archive.writestr(name, data)
+
+    # Дополнительные поля манифеста для продолжения сборки
+    def state(self):
+        return {}
+
+    def close(self):
+        self.archive.close()
+
+
+# Запись файлов в TAR-архив без сжатия. Прерванный архив обрезается до конца
+# последнего целого файла (позиция хранится в манифесте) и дописывается с этого места
+class TarArchiveWriter:
+    def __init__(self, archive_path, manifest):
+        offset = manifest.get('offset')
+        self.resumed = (
+            bool(manifest['completed']) and offset is not None
+            and os.path.exists(archive_path) and os.path.getsize(archive_path) >= offset
+        )
+        if self.resumed:
+            self.file = open(archive_path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(archive_path, 'wb')
+        # TarFile начинает запись с текущей позиции файла
+        self.archive = tarfile.open(fileobj=self.file, mode='w', format=tarfile.PAX_FORMAT)
+
+    def add(self, name, source, size, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        self.archive.addfile(info, source)
+
+    def add_bytes(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def state(self):
+        return {'offset': self.archive.offset}
+
+    def close(self):
+        self.archive.close()
+        self.file.close()
+
+
+ARCHIVE_WRITERS = {'zip': ZipArchiveWriter, 'tar': TarArchiveWriter}
+
+# Собрать архив из items в archive_path (archive_format - 'zip' или 'tar')
+# Уже записанные файлы отмечаются в манифесте, поэтому прерванную сборку можно продолжить
+# names - имена файлов в архиве (по умолчанию get_archive_names(items)), duplicates_name - имя списка копий
+async def write_archive(client, items, archive_path, cache=None, on_progress=None, archive_format='zip',
+                        names=None, duplicates_name=ARCHIVE_DUPLICATES_NAME):
+    manifest = load_manifest(archive_path)
+    # Манифест появляется до архива: архив без манифеста считается собранным полностью
+    save_manifest(archive_path, manifest)
+    writer = ARCHIVE_WRITERS[archive_format](archive_path, manifest)
+    completed = set(manifest['completed']) if writer.resumed else set()
+
+    try:
+        # Одно и то же фото или документ, сохраненные несколько раз, скачиваются и попадают в архив один раз
+        if names is None:
+            names = get_archive_names(items, (duplicates_name,))
+        dates = {item['id']: item['date'] for item in items}
+
+        # Получаем все сообщения одним пакетным запросом, вместе с копиями: если сообщение
+        # оригинала удалено, файл попадает в архив по первой уцелевшей копии
+        pending = [item for item in items if item['id'] not in completed]
+        messages = await call_with_retries(
+            lambda: client.get_messages('me', ids=[item['id'] for item in pending])
+        )
+
+        # Проверяем, что сообщение существует и содержит медиа
+        found = {message.id: message for message in messages if message and message.media}
+
+        # Оригинал - первое уцелевшее сообщение с тем же медиа; уже записанные в архив файлы
+        # остаются оригиналами, даже если продолженная сборка видит сообщения иначе
+        available = [item for item in items if item['id'] in completed]
+        available += [item for item in pending if item['id'] in found]
+        duplicates = find_duplicates(available)
+        media_messages = [
+            found[item['id']] for item in pending if item['id'] in found and item['id'] not in duplicates
+        ]
+
+        total = len(completed) + len(media_messages)
+        if on_progress is not None:
+            on_progress(len(completed), total)
+        started = time.monotonic()
+
+        # Файлы скачиваются параллельно, а в архив попадают по порядку. Недокачанные файлы остаются
+        # в кэше или рядом с архивом (get_archive_part_path), следующая попытка продолжит с того же места
+        downloads = iter_downloads_in_order(
+            client, media_messages, cache,
+            get_part_path=lambda message: get_archive_part_path(archive_path, message.id)
+        )
+        try:
+            async for message, spool in downloads:
+                size = spool.seek(0, os.SEEK_END)
+                spool.seek(0)
+                mtime = datetime.strptime(dates[message.id], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+                writer.add(names[message.id], spool, size, mtime.timestamp())
+                completed.add(message.id)
+                metrics.inc('telegram_archive_files_total')
+                save_manifest(archive_path, dict(writer.state(), completed=sorted(completed)))
+                try:
+                    os.remove(get_archive_part_path(archive_path, message.id))
+                except OSError:
+                    pass
+                if on_progress is not None:
+                    on_progress(len(completed), total)
+        except BaseException:
+            save_manifest(archive_path, dict(writer.state(), completed=sorted(completed)))
+            raise
+        finally:
+            await downloads.aclose()
+
+        # Вместо копий в архиве - список, какому файлу архива соответствует каждая копия
+        copies = [
+            f"{names[copy_id]} -> {names[original_id]}"
+            for copy_id, original_id in duplicates.items() if original_id in completed
+        ]
+        if copies:
+            writer.add_bytes(duplicates_name, ("\n".join(copies) + "\n").encode())
+    finally:
+        writer.close()
+
+    # Архив собран полностью - манифест больше не нужен
+    try:
+        os.remove(get_manifest_path(archive_path))
+    except FileNotFoundError:
+        pass
+    elapsed = time.monotonic() - started
+    metrics.observe('telegram_archive_build_seconds', elapsed)
+    log.info("Архив %s собран за %.2f с (%d файлов)", archive_path, elapsed, total)
+
+# Разбить items на тома не больше volume_size байт каждый (по размерам из индекса, вместе с заголовками архива)
+# Файл больше volume_size занимает отдельный том; копия попадает в том, где лежит ее оригинал
+# volume_size=None - один том со всеми файлами
+def plan_volumes(items, volume_size=None):
+    if not volume_size:
+        return [list(items)] if items else []
+
+    duplicates = find_duplicates(items)
+    copy_counts = collections.Counter(duplicates.values())
+    capacity = volume_size - ARCHIVE_VOLUME_RESERVE
+    volumes = []
+    current = []
+    current_size = 0
+    volume_of = {}
+    for item in items:
+        if item['id'] in duplicates:
+            continue
+        # Копии оригинала попадают в тот же том строкой списка копий - под нее тоже нужно место
+        size = (item['size'] or 0) + ARCHIVE_ENTRY_OVERHEAD * (1 + copy_counts[item['id']])
+        if current and current_size + size > capacity:
+            volumes.append(current)
+            current = []
+            current_size = 0
+        current.append(item)
+        current_size += size
+        volume_of[item['id']] = len(volumes)
+    if current:
+        volumes.append(current)
+
+    for item in items:
+        if item['id'] in duplicates:
+            volumes[volume_of[duplicates[item['id']]]].append(item)
+    return volumes
+
+# Путь тома index из count: единственный том лежит по пути archive_path, остальные - с номером
+def get_volume_path(archive_path, index, count):
+    if count == 1:
+        return archive_path
+    root, ext = os.path.splitext(archive_path)
+    return f"{root}_{index + 1:03d}{ext}"
+
+# Имя списка копий в томе index из count: у каждого тома свое, чтобы тома можно было распаковать в один каталог
+def get_volume_duplicates_name(index, count):
+    if count == 1:
+        return ARCHIVE_DUPLICATES_NAME
+    stem, ext = os.path.splitext(ARCHIVE_DUPLICATES_NAME)
+    return f"{stem}_{index + 1:03d}{ext}"
+
+# Собрать архив томами (см. plan_volumes) по очереди
+# on_volume(index, path) вызывается, как только том готов, - его можно отдавать, пока собирается следующий
+# Уже собранные тома прошлой попытки не собираются заново
+async def write_volumes(client, items, archive_path, cache=None, on_progress=None, on_volume=None,
+                        volume_size=None, archive_format='zip'):
+    volumes = plan_volumes(items, volume_size)
+    duplicates_names = [get_volume_duplicates_name(index, len(volumes)) for index in range(len(volumes))]
+    # Имена уникальны по всем томам сразу: распакованные в один каталог тома не перезаписывают файлы друг друга
+    names = get_archive_names(items, duplicates_names)
+    total = len(items) - len(find_duplicates(items))
+    done_before = 0
+    paths = []
+
+    for index, volume_items in enumerate(volumes):
+        path = get_volume_path(archive_path, index, len(volumes))
+        volume_total = len(volume_items) - len(find_duplicates(volume_items))
+        if not os.path.exists(path) or os.path.exists(get_manifest_path(path)):
+            await write_archive(
+                client, volume_items, path, cache,
+                on_progress=lambda done, _: on_progress(done_before + done, total) if on_progress else None,
+                archive_format=archive_format, names=names, duplicates_name=duplicates_names[index]
+            )
+        done_before += volume_total
+        if on_progress is not None:
+            on_progress(done_before, total)
+        paths.append(path)
+        if on_volume is not None:
+            on_volume(index, path)
+    return paths
+
+# Можно ли показать миниатюру для файла
+def has_preview(item):
+    return item['type'] in PREVIEW_MEDIA_TYPES or (item['mime_type'] or '').startswith('image/')
+
+# Ключ миниатюры в кэше: не зависит от размера миниатюры, чтобы находить ее без запроса к Telegram
+def preview_cache_key(item):
+    key = get_media_key(item)
+    if key is None:
+        return None
+    return f"preview_{key}"
+
+# Выбрать небольшую миниатюру, которую Telegram уже хранит для фото или документа
+def get_preview_thumb(message):
+    if message.photo:
+        thumbs = message.photo.sizes
+    elif message.document:
+        thumbs = message.document.thumbs
+    else:
+        thumbs = None
+
+    thumb_types = {thumb.type for thumb in thumbs or [] if not isinstance(thumb, types.PhotoPathSize)}
+    for thumb_type in PREVIEW_THUMB_TYPES:
+        if thumb_type in thumb_types:
+            return thumb_type
+    return None
+
+# Скачать в кэш миниатюры для items одним пакетом
+# Возвращает словарь id -> данные миниатюры и множество id файлов без миниатюр
+# (туда же попадают файлы, миниатюру которых скачать не удалось, - повторно они не запрашиваются)
+async def fetch_previews(client, items, cache):
+    messages = await call_with_retries(
+        lambda: client.get_messages('me', ids=[item['id'] for item in items])
+    )
+    slots = asyncio.Semaphore(PREVIEW_CONCURRENCY)
+    no_preview_ids = set()
+
+    async def fetch(item, message):
+        thumb = get_preview_thumb(message) if message else None
+        if thumb is None:
+            no_preview_ids.add(item['id'])
+            return None
+
+        async with slots:
+            temp_file = cache.new_file()
+            try:
+                with temp_file:
+                    # Скачивается только миниатюра, а не сам файл
+                    await client.download_media(message, temp_file, thumb=thumb)
+                path = cache.add(preview_cache_key(item), temp_file.name)
+            except Exception as e:
+                # Ошибка одной миниатюры (устаревшая ссылка на файл, ошибка DC) не мешает остальным
+                if os.path.exists(temp_file.name):
+                    os.remove(temp_file.name)
+                metrics.inc('telegram_errors_total')
+                log.warning("Не удалось скачать миниатюру сообщения %s: %s", item['id'], e)
+                no_preview_ids.add(item['id'])
+                return None
+            except BaseException:
+                if os.path.exists(temp_file.name):
+                    os.remove(temp_file.name)
+                raise
+        with open(path, 'rb') as preview_file:
+            return preview_file.read()
+
+    results = await asyncio.gather(
+        *(fetch(item, message) for item, message in zip(items, messages))
+    )
+    previews = {
+        item['id']: data for item, data in zip(items, results) if data
+    }
+    return previews, no_preview_ids
@@ -0,0 +1,305 @@
+import hashlib
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+from favorites_core import ARCHIVE_CHUNK_SIZE, call_with_retries, iter_media_range
+from metrics import metrics
+
+# Локальный HTTP-сервер потокового воспроизведения медиа из избранного для плееров st.video/st.audio.
+# Отдает файлы по ссылкам /media/<токен сессии>/<id сообщения> с поддержкой HTTP Range:
+# воспроизведение начинается после первого блока, а при перемотке скачиваются только нужные байты.
+# Подготовленные файлы и тома архивов отдаются с диска по ссылкам /file/<токен сессии>/<id файла>/<имя>,
+# поэтому Streamlit не читает их в память при каждом обновлении страницы
+
+log = logging.getLogger(__name__)
+
+MEDIA_STREAM_MESSAGE_TTL = 300  # секунд, в течение которых сообщение не запрашивается у Telegram заново
+MEDIA_STREAM_MAX_AGE = 3600  # секунд, которые браузер может хранить полученные байты
+MEDIA_STREAM_TOKEN_TTL = 1800  # секунд без запросов, после которых ссылки сессии перестают работать
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# Диапазон байт (start, end) из заголовка Range для файла размером size
+# None - отдать весь файл (заголовка нет или в нем несколько диапазонов), ValueError - диапазон вне файла
+def parse_range(header, size):
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None:
+        # Несколько диапазонов сразу плееры не запрашивают, заголовок можно не учитывать
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N - последние N байт
+        if not last or int(last) == 0:
+            raise ValueError(header)
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+class MediaStreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # pool - пул клиентов приложения, cache - кэш медиа (файлы из него отдаются без Telegram)
+    def __init__(self, address, pool, cache=None):
+        super().__init__(address, MediaStreamHandler)
+        self.pool = pool
+        self.cache = cache
+        self._sessions = {}  # токен -> (ключ клиента в пуле, строка сессии)
+        self._tokens = {}  # ключ клиента -> токен
+        self._last_used = {}  # токен -> время последнего обращения
+        self._messages = {}  # (ключ клиента, id сообщения) -> (сообщение, время получения)
+        self._files = {}  # (ключ клиента, id файла) -> (путь, имя файла при скачивании, MIME-тип)
+        self._lock = threading.Lock()
+        # Запомненные сообщения относятся к закрытому клиенту сессии. Сами ссылки действуют, пока сессию
+        # не отзовут при выходе или ими не перестанут пользоваться (MEDIA_STREAM_TOKEN_TTL)
+        pool.add_close_listener(self.forget_messages)
+
+    # Токен для ссылок сессии key; ссылки не меняются, пока сессия не отозвана и используется
+    def register(self, key, session_str):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            token = self._tokens.get(key)
+            if token is None:
+                token = self._tokens[key] = secrets.token_urlsafe(16)
+            self._sessions[token] = (key, session_str)
+            self._last_used[token] = now
+            return token
+
+    # Отозвать ссылки сессии key (при выходе пользователя)
+    def unregister(self, key):
+        with self._lock:
+            self._forget(key)
+
+    # Забыть сообщения сессии key, запомненные для плеера (при закрытии ее клиента в пуле)
+    def forget_messages(self, key):
+        with self._lock:
+            self._forget_messages(key)
+
+    # Сессия по токену из ссылки: (ключ клиента, строка сессии) или None
+    def lookup(self, token):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(token)
+            if session is not None:
+                self._last_used[token] = now
+            return session
+
+    # Разрешить сессии key скачивать файл path под именем filename; возвращает id файла для ссылки
+    def add_file(self, key, path, filename, mime_type=None):
+        file_id = hashlib.sha1(path.encode()).hexdigest()[:16]
+        with self._lock:
+            self._files[(key, file_id)] = (path, filename, mime_type)
+        return file_id
+
+    # Файл file_id сессии key: (путь, имя файла, MIME-тип) или None
+    def get_file(self, key, file_id):
+        with self._lock:
+            return self._files.get((key, file_id))
+
+    # Отозвать токены, которыми не пользовались дольше MEDIA_STREAM_TOKEN_TTL (вызывается под блокировкой)
+    def _expire(self, now):
+        for token, last_used in list(self._last_used.items()):
+            if now - last_used > MEDIA_STREAM_TOKEN_TTL:
+                self._forget(self._sessions[token][0])
+
+    # Удалить запомненные сообщения сессии key (вызывается под блокировкой)
+    def _forget_messages(self, key):
+        for message_key in [message_key for message_key in self._messages if message_key[0] == key]:
+            del self._messages[message_key]
+
+    # Удалить токен, файлы и запомненные сообщения сессии key (вызывается под блокировкой)
+    def _forget(self, key):
+        token = self._tokens.pop(key, None)
+        self._sessions.pop(token, None)
+        self._last_used.pop(token, None)
+        self._forget_messages(key)
+        for file_key in [file_key for file_key in self._files if file_key[0] == key]:
+            del self._files[file_key]
+
+    # Сообщение message_id сессии key: плеер делает много запросов подряд, поэтому оно ненадолго запоминается
+    def get_message(self, key, session_str, message_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._messages.get((key, message_id))
+            if cached is not None and now - cached[1] < MEDIA_STREAM_MESSAGE_TTL:
+                return cached[0]
+
+        async def fetch(client):
+            return await call_with_retries(lambda: client.get_messages('me', ids=message_id))
+
+        message = self.pool.run(key, session_str, fetch)
+        with self._lock:
+            for message_key, (_, fetched) in list(self._messages.items()):
+                if now - fetched >= MEDIA_STREAM_MESSAGE_TTL:
+                    del self._messages[message_key]
+            if message is not None:
+                self._messages[(key, message_id)] = (message, now)
+        return message
+
+
+class MediaStreamHandler(BaseHTTPRequestHandler):
+    # Соединение остается открытым между запросами диапазонов
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.route(send_body=True)
+
+    def do_HEAD(self):
+        self.route(send_body=False)
+
+    # Выбрать обработчик по пути запроса: /media/<токен>/<id сообщения> или /file/<токен>/<id файла>/<имя>
+    def route(self, send_body):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'media' and parts[2].isdigit():
+            handler = self.send_media
+        elif len(parts) == 4 and parts[0] == 'file':
+            handler = self.send_file
+        else:
+            self.send_error(404)
+            return
+        session = self.server.lookup(parts[1])
+        if session is None:
+            self.send_error(404)
+            return
+        handler(session, parts[2], send_body)
+
+    # Отправить заголовки ответа на запрос байт файла размером size с учетом заголовка Range
+    # Возвращает диапазон (start, end) или None, если диапазон вне файла (ответ 416 уже отправлен)
+    def send_range_headers(self, size, content_type, headers):
+        try:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        if byte_range is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        return start, end
+
+    # Медиа сообщения message_id из Telegram (или из кэша медиа)
+    def send_media(self, session, message_id, send_body):
+        key, session_str = session
+        try:
+            message = self.server.get_message(key, session_str, int(message_id))
+        except Exception as e:
+            metrics.inc('telegram_errors_total')
+            log.warning("Не удалось получить сообщение %s: %s", message_id, e)
+            self.send_error(502)
+            return
+        if not message or not message.file or not (message.photo or message.document):
+            self.send_error(404)
+            return
+
+        byte_range = self.send_range_headers(
+            message.file.size, message.file.mime_type or 'application/octet-stream',
+            [('Cache-Control', f'private, max-age={MEDIA_STREAM_MAX_AGE}')]
+        )
+        if byte_range is None or not send_body:
+            return
+        start, end = byte_range
+        if end < start:
+            return
+
+        metrics.inc('telegram_stream_requests_total')
+        started = time.monotonic()
+        sent = 0
+        stream = self.server.pool.iterate(
+            key, session_str, lambda client: iter_media_range(client, message, start, end, self.server.cache)
+        )
+        try:
+            for chunk in stream:
+                if not sent:
+                    metrics.observe('telegram_stream_first_chunk_seconds', time.monotonic() - started)
+                self.wfile.write(chunk)
+                sent += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # Плеер сам прервал запрос (например, при перемотке) - остаток диапазона не нужен
+            pass
+        except Exception as e:
+            # Заголовки уже отправлены - остается только оборвать ответ
+            metrics.inc('telegram_errors_total')
+            log.warning("Ошибка при передаче сообщения %s: %s", message.id, e)
+            self.close_connection = True
+        finally:
+            stream.close()
+            metrics.inc('telegram_stream_bytes_total', sent)
+
+    # Подготовленный файл file_id (скачанный файл или том архива) с диска
+    def send_file(self, session, file_id, send_body):
+        shared = self.server.get_file(session[0], file_id)
+        if shared is None:
+            self.send_error(404)
+            return
+        path, filename, mime_type = shared
+        try:
+            shared_file = open(path, 'rb')
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with shared_file:
+            byte_range = self.send_range_headers(
+                os.fstat(shared_file.fileno()).st_size, mime_type or 'application/octet-stream',
+                [
+                    ('Content-Disposition', f"attachment; filename*=UTF-8''{quote(filename, safe='')}"),
+                    ('Cache-Control', 'private, no-cache'),
+                ]
+            )
+            if byte_range is None or not send_body:
+                return
+            start, end = byte_range
+            remaining = end - start + 1
+            sent = 0
+            shared_file.seek(start)
+            try:
+                while remaining > 0:
+                    chunk = shared_file.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        # Файл укоротился после отправки заголовков - ответ приходится оборвать
+                        self.close_connection = True
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    sent += len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # Браузер прервал скачивание - он продолжит его отдельным запросом диапазона
+                pass
+            finally:
+                metrics.inc('file_download_bytes_total', sent)
+
+    # Запросы плеера не засоряют лог приложения
+    def log_message(self, format, *args):
+        pass
+
+# Запустить сервер потокового воспроизведения в фоновом потоке
+def start_media_server(pool, cache, port, host='127.0.0.1'):
+    server = MediaStreamServer((host, port), pool, cache)
+    threading.Thread(target=server.serve_forever, name="media-http", daemon=True).start()
+    return server
@@ -0,0 +1,135 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    # Модуля нет в Windows - пиковая память процесса там не показывается
+    resource = None
+
+# Метрики ввода-вывода Telegram, общие для всего процесса.
+# Отдаются в текстовом формате Prometheus (render), HTTP-сервером (start_metrics_server)
+# и на странице администратора в app.py
+
+# Описания метрик для строк # HELP
+METRICS_HELP = {
+    'telegram_connect_seconds': "Время подключения клиента к Telegram",
+    'telegram_listing_seconds': "Время получения списка избранного",
+    'telegram_file_download_bytes': "Байт скачано за одну загрузку файла",
+    'telegram_file_download_seconds': "Время загрузки одного файла",
+    'telegram_download_throughput_bytes_per_second': "Скорость загрузки одного файла",
+    'telegram_archive_build_seconds': "Время сборки архива",
+    'telegram_archive_files_total': "Файлов записано в архивы",
+    'telegram_flood_waits_total': "Сколько раз Telegram ответил FloodWait",
+    'telegram_flood_wait_seconds_total': "Сколько секунд суммарно ждали из-за FloodWait",
+    'telegram_retries_total': "Повторы операций после сетевых ошибок и FloodWait",
+    'telegram_errors_total': "Операции, завершившиеся ошибкой",
+    'telegram_download_buffer_bytes': "Байт частей больших файлов в памяти",
+    'telegram_scheduler_wait_seconds_total': "Сколько секунд запросы ждали очереди в планировщике",
+    'telegram_jobs_running': "Фоновых задач выполняется",
+    'telegram_jobs_queued': "Фоновых задач ждет в очереди из-за квот",
+    'telegram_admitted_bytes': "Байт скачивают выполняющиеся фоновые задачи",
+    'telegram_connections': "Соединений с Telegram выделено сессиям",
+    'telegram_admission_queued_total': "Сколько раз задача или соединение ждали в очереди из-за квот",
+    'telegram_admission_rejected_total': "Сколько задач отклонено из-за квот",
+    'telegram_stream_requests_total': "Запросов к серверу потокового воспроизведения",
+    'telegram_stream_bytes_total': "Байт отдано плеерам",
+    'telegram_stream_first_chunk_seconds': "Время до первого блока ответа плееру",
+    'file_download_bytes_total': "Байт подготовленных файлов и архивов отдано браузерам",
+}
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # имя -> значение
+        self._gauges = {}  # имя -> [текущее значение, максимум]
+        self._summaries = {}  # имя -> [количество, сумма, максимум]
+        self.started = time.time()
+
+    # Увеличить счетчик
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    # Изменить текущее значение (например, занятый буфер) на delta, запоминая максимум
+    def add(self, name, delta):
+        with self._lock:
+            gauge = self._gauges.setdefault(name, [0, 0])
+            gauge[0] += delta
+            gauge[1] = max(gauge[1], gauge[0])
+
+    # Записать одно наблюдение (длительность, размер)
+    def observe(self, name, value):
+        with self._lock:
+            summary = self._summaries.setdefault(name, [0, 0, 0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    # Снимок всех метрик: список (имя, тип, значения) для отображения
+    def snapshot(self):
+        with self._lock:
+            rows = [(name, 'counter', {'value': value}) for name, value in self._counters.items()]
+            rows += [
+                (name, 'gauge', {'value': value, 'peak': peak})
+                for name, (value, peak) in self._gauges.items()
+            ]
+            rows += [
+                (name, 'summary', {'count': count, 'sum': total, 'max': peak})
+                for name, (count, total, peak) in self._summaries.items()
+            ]
+        if resource is not None:
+            # ru_maxrss в Linux - в килобайтах
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            rows.append(('process_peak_rss_bytes', 'gauge', {'value': peak_rss}))
+        rows.append(('process_uptime_seconds', 'gauge', {'value': time.time() - self.started}))
+        return sorted(rows, key=lambda row: row[0])
+
+    # Метрики в текстовом формате Prometheus
+    def render(self):
+        lines = []
+        for name, kind, values in self.snapshot():
+            if name in METRICS_HELP:
+                lines.append(f"# HELP {name} {METRICS_HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'summary':
+                lines.append(f"{name}_count {values['count']}")
+                lines.append(f"{name}_sum {values['sum']}")
+                # Максимум не входит в формат summary - отдаем его отдельной метрикой
+                lines.append(f"# TYPE {name}_max gauge")
+                lines.append(f"{name}_max {values['max']}")
+            else:
+                lines.append(f"{name} {values['value']}")
+                if 'peak' in values:
+                    lines.append(f"# TYPE {name}_peak gauge")
+                    lines.append(f"{name}_peak {values['peak']}")
+        return "\n".join(lines) + "\n"
+
+
+# Метрики процесса
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Запросы Prometheus не засоряют лог приложения
+    def log_message(self, format, *args):
+        pass
+
+# Запустить HTTP-сервер метрик (GET /metrics) в фоновом потоке
+def start_metrics_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server